@@ -1,61 +1,224 @@
 import psycopg2
+import psycopg2.extras
 import numpy as np
+import threading
+import contextlib
+import queue
+import time
+import io
+import csv
+import os
+import config
+
+_INTTYPES = { 20, 21, 23 } # PostgreSQL type OIDs for int8, int2, int4
+_FLOATTYPES = { 700, 701, 1700 } # float4, float8, numeric
 
 class DB:
-    def __init__(self, **kwargs):
+    def __init__(self, maxconn=16, **kwargs):
+        '''DB - Connection to the alignment database
+        db = DB() connects to the database specified in config.py.
+        Connections are handed out from a pool that is shared by all
+        threads using the DB object, so that Factory workers do not
+        have to wait for each other's queries. At most MAXCONN connections
+        are open at any time; further requests block until one is returned.
+        Keyword arguments are passed to psycopg2.connect.'''
         if 'host' not in kwargs:
             kwargs['host'] = config.dbhost
         if 'user' not in kwargs:
             kwargs['user'] = config.dbuser
         if 'database' not in kwargs:
             kwargs['database'] = config.database
-        self.db = psycopg2.connect(**kwargs)
+        self.connargs = kwargs
+        self.maxconn = maxconn
+        self.idle = [] # Connections not currently in use
+        self.nconn = 0 # Total number of open connections
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        self.pid = os.getpid()
+        self.orphans = []
+        self._release(self._acquire()) # Fail early if we cannot connect
+
+    def _checkfork(self):
+        # In a forked worker process, the connections belong to the parent.
+        # We must not use them, nor close them, because closing would
+        # terminate the parent's sessions. So we just hang on to them.
+        if os.getpid() == self.pid:
+            return
+        self.orphans += self.idle
+        self.orphans.append(self.local)
+        self.idle = []
+        self.nconn = 0
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        self.pid = os.getpid()
+
+    def _acquire(self):
+        self._checkfork()
+        with self.cond:
+            while len(self.idle)==0 and self.nconn >= self.maxconn:
+                self.cond.wait()
+            if len(self.idle):
+                return self.idle.pop()
+            self.nconn += 1
+        try:
+            return psycopg2.connect(**self.connargs)
+        except:
+            with self.cond:
+                self.nconn -= 1
+                self.cond.notify()
+            raise
+
+    def _release(self, con):
+        with self.cond:
+            if con.closed:
+                self.nconn -= 1
+            else:
+                self.idle.append(con)
+            self.cond.notify()
+
+    def _current(self):
+        # Connection already held by the calling thread, if any
+        self._checkfork()
+        con = getattr(self.local, 'con', None)
+        if con is not None and not con.closed:
+            return con
+        return None
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''CONNECTION - Borrow a connection from the pool
+        with db.connection() as con: ... gives the calling thread exclusive
+        use of a connection for the duration of the block. If the thread
+        already holds a connection, that same connection is reused.'''
+        con = self._current()
+        if con is not None:
+            yield con
+            return
+        con = self._acquire()
+        self.local.con = con
+        try:
+            yield con
+        finally:
+            self.local.con = None
+            self._release(con)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''TRANSACTION - Run several statements in a single transaction
+        with db.transaction() as c: ... yields a cursor on a pooled
+        connection. The transaction is committed at the end of the block,
+        or rolled back if an exception occurs. A TRANSACTION block inside
+        another one is simply part of the outer transaction, as are
+        EXE, SEL, etc., called from inside the block.'''
+        nested = getattr(self.local, 'txdepth', 0) > 0
+        with self.connection() as con:
+            with contextlib.nullcontext() if nested else con:
+                with con.cursor() as c:
+                    self.local.txdepth = getattr(self.local, 'txdepth', 0) + 1
+                    try:
+                        yield c
+                    finally:
+                        self.local.txdepth -= 1
+
+    def _run(self, foo):
+        # Runs FOO(cursor) in its own transaction, or as part of the
+        # calling thread's TRANSACTION block if there is one. If the
+        # connection turns out to have been lost, we reconnect and try
+        # once more. That is not done inside a TRANSACTION block, because
+        # the earlier part of that transaction would be lost.
+        nested = getattr(self.local, 'txdepth', 0) > 0
+        attempt = 0
+        while True:
+            with self.connection() as con:
+                try:
+                    if nested:
+                        with con.cursor() as c:
+                            return foo(c)
+                    with con:
+                        with con.cursor() as c:
+                            return foo(c)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    if nested or attempt>0 or not con.closed:
+                        raise
+                    print('Lost database connection; reconnecting')
+                    self.close() # Idle connections are probably dead too
+            attempt += 1
+
+    def close(self):
+        '''CLOSE - Close all idle connections in the pool'''
+        with self.cond:
+            for con in self.idle:
+                con.close()
+            self.nconn -= len(self.idle)
+            self.idle = []
 
     def exe(self, sql, args=None):
         '''EXE - Execute a single SQL statement in its own transaction'''
-        with self.db:
-            with self.db.cursor() as c:
-                c.execute(sql, args)
+        def foo(c):
+            c.execute(sql, args)
+        self._run(foo)
     
     def nofail(self, sql, args=None):
         '''NOFAIL - Like EXE, but catches exceptions'''
-        with self.db:
-            with self.db.cursor() as c:
-                try:
-                    c.execute(sql, args)
-                except Exception as e:
-                    print(e)
+        def foo(c):
+            try:
+                c.execute(sql, args)
+            except Exception as e:
+                print(e)
+        self._run(foo)
                     
     def sel(self, sql, args=None):
         '''SEL - Run a SQL statement in its own transaction and return all
                  fetched rows.'''
-        with self.db:
-            with self.db.cursor() as c:
-                c.execute(sql, args)
-                return c.fetchall()
+        def foo(c):
+            c.execute(sql, args)
+            return c.fetchall()
+        return self._run(foo)
     
     def vsel(self, sql, args=None):
         '''VSEL - Like SEL, but returns results as a list of numpy arrays.
         VSEL(sql, args) executes the SQL code, interpolating ARGS for "%s"
-        placeholders, and returns the results as a list of numpy arrays.'''
-        with self.db:
-            with self.db.cursor() as c:
-                c.execute(sql, args)
-                ncols = len(c.description)
-                raw = c.fetchall()
-        raw = self.sel(sql, args)
-        nrows = len(raw)
-        if nrows==0:
+        placeholders, and returns the results as a list of numpy arrays.
+        Integer columns become integer arrays, other numeric columns become
+        float arrays. When all columns are numeric, the rows are streamed
+        using COPY and parsed column-wise, which is much faster than
+        fetching them as Python tuples. NULLs become NaN.'''
+        def foo(c):
+            query = c.mogrify(sql, args).decode().strip().rstrip(';')
+            # Find column types without actually running the query
+            c.execute(f'select * from ({query}) as vselq limit 0')
+            types = [d.type_code for d in c.description]
+            if all(t in _INTTYPES or t in _FLOATTYPES for t in types):
+                buf = io.StringIO()
+                c.copy_expert(f"""copy ({query}) to stdout
+                with (format csv, null 'NaN')""", buf)
+                return types, buf.getvalue()
+            else:
+                c.execute(query)
+                return types, c.fetchall()
+        types, raw = self._run(foo)
+        ncols = len(types)
+        if len(raw)==0:
             return [np.array([])] * ncols
+        if type(raw)==str:
+            raw = np.loadtxt(io.StringIO(raw), delimiter=',', ndmin=2)
+            res = []
+            for c in range(ncols):
+                ar = np.ascontiguousarray(raw[:,c])
+                if types[c] in _INTTYPES and not np.any(np.isnan(ar)):
+                    ar = ar.astype(int)
+                res.append(ar)
+            return res
+        # Fallback for non-numeric columns
         res = []
         for c in range(ncols):
-            if type(raw[0][c])==int:
-                ar = np.zeros(nrows, dtype=int)
+            col = [row[c] for row in raw]
+            if types[c] in _INTTYPES:
+                res.append(np.array(col, dtype=int))
+            elif types[c] in _FLOATTYPES:
+                res.append(np.array(col, dtype=float))
             else:
-                ar = np.zeros(nrows)
-            for r in range(nrows):
-                ar[r] = raw[r][c]
-            res.append(ar)
+                res.append(np.array(col))
         return res
 
     class Runlet:
@@ -202,3 +365,234 @@ class DB:
             res.zz0[r] = row[3]
         return res
 
+
+    class Sink:
+        '''SINK - Buffered writer for result rows
+        Use DB.SINK to create one.'''
+        def __init__(self, db, table, columns, keys=None,
+                     batchsize=1000, maxdelay=10, done=None):
+            self.db = db
+            self.table = table
+            self.columns = columns
+            if keys is None:
+                keys = []
+            self.keys = keys
+            self.keyidx = [columns.index(k) for k in keys]
+            self.done = done
+            if done is not None:
+                self.doneidx = [columns.index(k) for k in done.keys]
+            self.batchsize = batchsize
+            self.maxdelay = maxdelay
+            self.rows = []
+            self.lock = threading.Lock()
+            self.qu = queue.Queue(4)
+            # Rows that the writer took directly from the buffer after
+            # MAXDELAY, rather than from the queue, and has not yet
+            # committed. FLUSH waits for these as well as for the queue.
+            self.inflight = 0
+            self.idle = threading.Condition(self.lock)
+            self.fails = []
+            self.thr = threading.Thread(target=self._writer, daemon=True)
+            self.thr.start()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            self.close()
+
+        def add(self, *row):
+            '''ADD - Add a row to the buffer
+            ADD(v1, v2, ...) adds a row with values for each of the columns
+            of the sink. This only blocks if the writer has fallen far
+            behind.'''
+            if len(row) != len(self.columns):
+                raise ValueError(f'Expected {len(self.columns)} values')
+            with self.lock:
+                self.rows.append(row)
+                if len(self.rows) < self.batchsize:
+                    return
+                batch = self.rows
+                self.rows = []
+            self.qu.put(batch)
+
+        def flush(self):
+            '''FLUSH - Write all buffered rows and wait until they are
+            committed.'''
+            with self.lock:
+                batch = self.rows
+                self.rows = []
+            if len(batch):
+                self.qu.put(batch)
+            self.qu.join()
+            with self.lock:
+                while self.inflight:
+                    self.idle.wait()
+
+        def close(self):
+            '''CLOSE - Flush and stop the writer thread
+            Raises an exception if any rows could not be written.'''
+            if self.thr is None:
+                return
+            self.flush()
+            self.qu.put(None)
+            self.thr.join()
+            self.thr = None
+            if len(self.fails):
+                raise Exception(f'Failed to write {len(self.fails)} rows'
+                                + f' to {self.table}')
+
+        def _writer(self):
+            while True:
+                fromqueue = True
+                try:
+                    batch = self.qu.get(timeout=self.maxdelay)
+                except queue.Empty:
+                    fromqueue = False
+                    with self.lock:
+                        batch = self.rows
+                        self.rows = []
+                        self.inflight += 1
+                if batch is None:
+                    self.qu.task_done()
+                    return
+                if len(batch):
+                    self._writebatch(batch)
+                if fromqueue:
+                    self.qu.task_done()
+                else:
+                    with self.lock:
+                        self.inflight -= 1
+                        self.idle.notify_all()
+
+        def _writebatch(self, batch):
+            # Rows are only dropped from memory once committed. A failed
+            # batch is retried as a whole, so rows may be written twice if
+            # a commit succeeds but its acknowledgment is lost, unless the
+            # sink has KEYS.
+            if len(self.keys):
+                # Only the last row for each key is kept, as it would
+                # replace any earlier one anyway
+                last = {}
+                for row in batch:
+                    last[tuple(row[k] for k in self.keyidx)] = row
+                batch = list(last.values())
+            for attempt in range(5):
+                try:
+                    replaced = self._write(batch)
+                except Exception as e:
+                    print(f'Failed to write {len(batch)} rows'
+                          + f' to {self.table}:', e)
+                    time.sleep(2**attempt)
+                    continue
+                # The DONE index only learns about rows once they are
+                # committed, and rows that replaced earlier ones are not
+                # counted twice
+                if self.done is not None:
+                    for row in batch:
+                        self.done.add(*[row[k] for k in self.doneidx])
+                    for key in replaced:
+                        self.done.add(*key, n=-1)
+                return
+            self.fails += batch
+
+        def _write(self, batch):
+            # Writes the batch in a single transaction and returns the
+            # DONE keys of any existing rows that it replaced
+            buf = io.StringIO()
+            csv.writer(buf).writerows(batch)
+            buf.seek(0)
+            cols = ','.join(self.columns)
+            replaced = []
+            with self.db.transaction() as c:
+                if len(self.keys):
+                    keys = ','.join(self.keys)
+                    keyrows = [tuple(row[k] for k in self.keyidx)
+                               for row in batch]
+                    if self.done is not None:
+                        ret = 'returning ' + ','.join(self.done.keys)
+                    else:
+                        ret = ''
+                    replaced = psycopg2.extras.execute_values(c, f'''delete
+                    from {self.table} where ({keys}) in (values %s) {ret}''',
+                                                   keyrows, page_size=1000,
+                                                   fetch=ret!='')
+                c.copy_expert(f'''copy {self.table} ({cols})
+                from stdin with (format csv)''', buf)
+            return replaced
+
+    def sink(self, table, columns, keys=None, batchsize=1000, maxdelay=10,
+             done=None):
+        '''SINK - Buffered writer for result rows
+        snk = SINK(table, columns) returns a SINK object for inserting rows
+        into the named TABLE. COLUMNS must be a list of column names.
+        Worker threads call snk.add(v1, v2, ...) with one value per column.
+        Rows are collected into batches of up to BATCHSIZE rows, which a
+        background thread writes using COPY in a single transaction.
+        Buffered rows are also written if no batch has been completed for
+        MAXDELAY seconds.
+        Optional argument KEYS is a list of columns that identify a result.
+        If given, existing rows with the same keys are deleted before each
+        batch is written, so that results can be replaced. Of several rows
+        with the same keys in one batch, only the last is written.
+        Call snk.close() after the Factory that feeds the sink has shut
+        down, to write any remaining rows.
+        Rows that fail to be written are retried, so every row added is
+        written at least once.
+        Optional argument DONE is a DONE index for the same table, which
+        is updated once rows are committed. Replaced rows are not counted
+        twice.'''
+        return DB.Sink(self, table, columns, keys, batchsize, maxdelay, done)
+
+    class Done:
+        '''DONE - In-memory index of completed work
+        Use DB.DONE to create one.'''
+        def __init__(self, db, table, keys, where=None):
+            self.table = table
+            self.keys = keys
+            self.lock = threading.Lock()
+            self.counts = {} # Map from key prefixes to row counts
+            cols = ','.join(keys)
+            sql = f'select {cols}, count(1) from {table}'
+            if where is not None:
+                sql += f' where {where}'
+            sql += f' group by {cols}'
+            for row in db.sel(sql):
+                self._add(tuple(row[:-1]), row[-1])
+
+        def _add(self, key, n):
+            for k in range(len(key) + 1):
+                pfx = key[:k]
+                self.counts[pfx] = self.counts.get(pfx, 0) + n
+
+        def add(self, *key, n=1):
+            '''ADD - Record that rows have been written
+            ADD(k1, k2, ...) records that a row has been written with the
+            given values for each of the key columns. Optional argument N
+            specifies the number of rows.'''
+            if len(key) != len(self.keys):
+                raise ValueError(f'Expected {len(self.keys)} key values')
+            with self.lock:
+                self._add(tuple(key), n)
+
+        def count(self, *key):
+            '''COUNT - Number of rows written
+            COUNT(k1, k2, ...) returns the number of rows in the table that
+            match the given values for the first few key columns. COUNT()
+            returns the total number of rows.'''
+            if len(key) > len(self.keys):
+                raise ValueError(f'Expected at most {len(self.keys)} values')
+            return self.counts.get(tuple(key), 0)
+
+    def done(self, table, keys, where=None):
+        '''DONE - Index of completed work
+        idx = DONE(table, keys) loads the number of rows in the named TABLE
+        for each combination of values in the list of KEYS columns, using
+        a single grouped query. After that, idx.count(k1, ...) answers how
+        many rows match the given values for the first few keys without
+        touching the database. Use idx.add(k1, ...) to record new rows,
+        or pass the index to SINK, which does that automatically.
+        Optional argument WHERE restricts which rows are considered.
+        Since only key prefixes can be looked up, order KEYS from the
+        coarsest to the finest grouping that will be asked about.'''
+        return DB.Done(self, table, keys, where)
@@ -7,30 +7,74 @@ import queue
 import sys
 import traceback
 import socket
+import multiprocessing
+import concurrent.futures
+import collections
 
 hostname = socket.gethostname()
 
+_factories = {} # Process-based factories, so that workers can find them
+
+def _produceinworker(fid, tsk):
+    return _factories[fid].produce(*tsk)
+
+def ascompleted(futs, timeout=None):
+    '''ASCOMPLETED - Iterate over futures as they complete
+    for fut in ASCOMPLETED(futs): ... yields the futures returned by
+    Factory.request in the order in which they complete.'''
+    return concurrent.futures.as_completed(futs, timeout)
+
 class Factory:
-    def __init__(self, nthr=4):
+    def __init__(self, nthr=4, processes=False, initializer=None, initargs=()):
+        '''FACTORY - Run tasks in parallel
+        fac = FACTORY(nthr) creates a factory with NTHR worker threads.
+        fac = FACTORY(nthr, processes=True) creates a factory with NTHR
+        worker processes instead. That is useful for tasks that spend most
+        of their time in Python code and so would hold the GIL.
+        Worker processes are forked, so they start with a copy of
+        the state of the main program, including module-level DB objects
+        and runinfo; DB objects reconnect by themselves. Tasks and their
+        arguments must be picklable, so functions must be defined at
+        module level. Optional argument INITIALIZER is a function that is
+        called with INITARGS at the start of each worker process.'''
         if hostname != 'leechem':
             nthr = 0
         self.nthr = nthr
+        self.processes = processes
         self.fails = {}
+        if processes:
+            self.thr = []
+            self.pool = None
+            if nthr > 0:
+                _factories[id(self)] = self
+                ctx = multiprocessing.get_context('fork')
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    nthr, mp_context=ctx,
+                    initializer=initializer, initargs=initargs)
+                self.slots = threading.Semaphore(2*nthr)
+            elif initializer is not None:
+                initializer(*initargs)
+            return
         def wrkr():
             try:
                 while True:
-                    tsk = self.qu.get()
-                    if tsk is None:
+                    item = self.qu.get()
+                    if item is None:
                         self.qu.task_done()
                         #print('Worker done')
                         return
+                    tsk, fut = item
+                    if not fut.set_running_or_notify_cancel():
+                        self.qu.task_done()
+                        continue
                     try:
                         #print('Retrieved task', tsk)
-                        self.produce(*tsk)
+                        fut.set_result(self.produce(*tsk))
                     except Exception  as e:
                         ei = sys.exc_info()
                         tb = ei[2]
                         self.fails[tsk] = (e, tb)
+                        fut.set_exception(e)
                         print("Traceback:")
                         traceback.print_tb(tb)
                         print("Exception:\n ", e)
@@ -46,7 +90,7 @@ class Factory:
             self.thr.append(t)
 
     def __enter__(self):
-        while len(self.thr) < self.nthr:
+        while not self.processes and len(self.thr) < self.nthr:
             t = threading.Thread(target=wrkr)
             t.start()
             self.thr.append(t)
@@ -63,6 +107,12 @@ class Factory:
         self.shutdown()
         
     def shutdown(self):
+        if self.processes:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+                del _factories[id(self)]
+            return
         #print('Sending None tasks')
         for n in range(len(self.thr)):
             self.qu.put(None)
@@ -75,20 +125,59 @@ class Factory:
 
     def produce(self, *tsk):
         '''Subclasses should override this to do the work.
-        Signal failure by raising an exception.'''
+        Signal failure by raising an exception. The return value becomes
+        the result of the future returned by REQUEST.'''
         tsk = list(tsk)
         foo = tsk.pop(0)
-        foo(*tsk)
+        return foo(*tsk)
+
+    def _done(self, tsk, fut):
+        # Called when a task in a worker process has completed
+        self.slots.release()
+        e = fut.exception()
+        if e is not None:
+            tb = e.__traceback__
+            self.fails[tsk] = (e, tb)
+            if e.__cause__ is not None:
+                print("Traceback:", e.__cause__)
+            print("Exception:\n ", e)
+            print('FAILED TO PRODUCE', tsk)
 
     def request(self, *tsk):
-        '''Clients call this to add a task to the queue.'''
+        '''Clients call this to add a task to the queue.
+        Returns a concurrent.futures.Future that will hold the result
+        of the task. This blocks while the queue is full.'''
         if self.nthr==0:
-            self.produce(*tsk)
+            fut = concurrent.futures.Future()
+            fut.set_result(self.produce(*tsk))
+        elif self.processes:
+            # Block while enough tasks are waiting already
+            self.slots.acquire()
+            fut = self.pool.submit(_produceinworker, id(self), tsk)
+            fut.add_done_callback(lambda fut: self._done(tsk, fut))
         else:
+            fut = concurrent.futures.Future()
             try:
-                self.qu.put(tsk)
+                self.qu.put((tsk, fut))
             except KeyboardInterrupt:
                 sys.exit(1)
+        return fut
+
+    def map(self, foo, *args):
+        '''MAP - Run a function for many arguments and collect results
+        for res in fac.MAP(foo, xx, yy): ... requests FOO(x, y) for each
+        pair of elements of XX and YY and yields the results in order.
+        Tasks are requested as results are consumed, so that no more than
+        a few tasks per worker are outstanding at any time. If a task
+        failed, its exception is raised when its result is reached.
+        This only works with the function-based approach.'''
+        pending = collections.deque()
+        for tsk in zip(*args):
+            pending.append(self.request(foo, *tsk))
+            while len(pending) > 2*self.nthr:
+                yield pending.popleft().result()
+        while len(pending):
+            yield pending.popleft().result()
 
     def failures(self):
         '''At the end, return dict of failed requests.'''
@@ -143,3 +232,16 @@ if __name__ == '__main__':
             
     # Of course, failures can be captured the same way in the class-based
     # approach.
+
+    #################### Collecting results ######################
+    def addfunc(a, b):
+        time.sleep(.1)
+        return a + b
+    with Factory() as f:
+        # REQUEST returns a future...
+        futs = [f.request(addfunc, k, 1) for k in range(5)]
+        for fut in ascompleted(futs):
+            print('Completed:', fut.result())
+        # ... and MAP yields results in order
+        for c in f.map(addfunc, range(5), range(5)):
+            print('Mapped:', c)
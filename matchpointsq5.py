@@ -17,10 +17,18 @@ import aligndb
 import numpy as np
 import scipy.sparse
 import scipy.sparse.linalg
+import scipy.spatial
 
 db = aligndb.DB()
 ri = db.runinfo()
 
+# SNR of the last swim pass actually run. Later passes may be skipped
+# (see SWIMBATCH.SKIPPED), in which case their SNR is stored as NaN and
+# NPASS says which pass was last. For rows from before NPASS existed,
+# all passes were run.
+LASTSNR2 = 'case npass when 1 then snr else snrb end'
+LASTSNR3 = 'case npass when 1 then snr when 2 then snrb else snrc end'
+
 def dynamicthreshold(snrs):
     return 0.5 * np.max(snrs)
 
@@ -98,7 +106,7 @@ class MatchPoints:
         y1-dy/2-dyb/2-dyc/2,
         x2+dx/2+dxb/2+dxc/2,
         y2+dy/2+dyb/2+dyc/2,
-        snrc from {crosstbl}
+        {LASTSNR3} from {crosstbl}
         where r={r} and m1={m1} and m2={m2} {swhere}
         order by ii''')
         if perslice:
@@ -167,7 +175,7 @@ class MatchPoints:
         (iy+0.5)*{Y}-dy/2-dyb/2,
         x+dx/2+dxb/2,
         y+dy/2+dyb/2,
-        snrb
+        {LASTSNR2}
         from {transtbl}
         where r={r1} and m={m1} and r2={r2}''')
         if thr is None:
@@ -220,7 +228,7 @@ class MatchPoints:
         bck = {} # keys are (m1,m2) [not the other way around]
         minthr = thr
         if minthr is None:
-            snr = db.vsel(f'''select snrb from {transtbl}
+            snr = db.vsel(f'''select {LASTSNR2} from {transtbl}
             where r={r1} and r2={r2}''')
             minthr = np.max((10, 0.2 * dynamicthreshold(snr)))
             thr = -minthr
@@ -266,7 +274,7 @@ class MatchPoints:
         (iy+0.5)*{Y}-dy/2-dyb/2,
         (ix+0.5)*{X}+dx/2+dxb/2,
         (iy+0.5)*{Y}+dy/2+dyb/2,
-        snrb
+        {LASTSNR2}
         from {intratbl}
         where r={r} and m={m} and s>{s0} and s<{s1}''')
         mpp = []
@@ -296,7 +304,7 @@ class MatchPoints:
         iy*{Y}+y-dy/2-dyb/2,
         ix*{X}+x+dx/2+dxb/2,
         iy*{Y}+y+dy/2+dyb/2,
-        snrb
+        {LASTSNR2}
         from {edgetbl}
         where r={r} and m={m} and s>{s0} and s<{s1}''')
         mpp = []
@@ -462,25 +470,52 @@ def weightdx(mp, ax):
         Dx = np.mean(mp.xp(ax) - mp.x(ax))
     return w, Dx
 
-def matrix(mpp, idx, ax):
+def _springs(p, pp, w):
+    # Returns (row, col, value) triplets that add springs with weights W
+    # between the matrix entries in P and in PP.
+    rows = np.concatenate((p, pp, p, pp))
+    cols = np.concatenate((p, pp, pp, p))
+    vals = np.concatenate((w, w, -w, -w))
+    return rows, cols, vals
+
+def matrix(mpp, idx):
+    '''Returns a sparse (CSR) matrix A and a K x 2 matrix b such that
+    solving A x = b optimizes tile positions. The first column of b is
+    for the x-axis, the second for the y-axis. A is the same for both.
+    Use SOLVE to solve the system.'''
     EPSILON = 1e-6
     K = len(idx)
-    A = np.eye(K) * EPSILON
-    b = np.zeros(K)
-    j = 0
-    for mp in mpp:
-        k = idx[(mp.r1, mp.m1, mp.s1)]
-        kp = idx[(mp.r2, mp.m2, mp.s2)]
-        w, Dx = weightdx(mp, ax)
-        A[k,k] += w
-        A[kp,kp] += w
-        A[k,kp] -= w
-        A[kp,k] -= w
-        b[k] += w*Dx
-        b[kp] -= w*Dx
-        j += 1
+    N = len(mpp)
+    k = np.zeros(N, dtype=int)
+    kp = np.zeros(N, dtype=int)
+    w = np.zeros(N)
+    Dx = np.zeros((N, 2))
+    for j in range(N):
+        mp = mpp[j]
+        k[j] = idx[(mp.r1, mp.m1, mp.s1)]
+        kp[j] = idx[(mp.r2, mp.m2, mp.s2)]
+        for ax in range(2):
+            w[j], Dx[j,ax] = weightdx(mp, ax)
+    rows, cols, vals = _springs(k, kp, w)
+    rows = np.concatenate((np.arange(K), rows))
+    cols = np.concatenate((np.arange(K), cols))
+    vals = np.concatenate((np.ones(K) * EPSILON, vals))
+    A = scipy.sparse.coo_matrix((vals, (rows, cols)), (K,K)).tocsr()
+    b = np.zeros((K, 2))
+    for ax in range(2):
+        b[:,ax] = np.bincount(k, w*Dx[:,ax], K) - np.bincount(kp, w*Dx[:,ax], K)
     return A, b
 
+def solve(A, b):
+    '''SOLVE - Solve a system from MATRIX or ELASTICMATRIX for both axes
+    x, y = SOLVE(A, b) factorizes A once and uses the factorization to
+    solve for both columns of b.'''
+    # A is symmetric, so order the factorization for A + A' rather
+    # than for A'A.
+    lu = scipy.sparse.linalg.splu(A.tocsc(), permc_spec='MMD_AT_PLUS_A')
+    xy = lu.solve(b)
+    return xy[:,0], xy[:,1]
+
 def tension(mpp, idx, xm, ym):
     res = {}
     for mp in mpp:
@@ -519,84 +554,68 @@ def elastictension(mpp, idx, xm, ym):
         res[(rms1, rms2)] = (np.max(np.array(sxx)**2), np.max(np.array(syy)**2))
     return res
 
-def elasticmatrix(mpp, idx, ap, ax):
+def elasticmatrix(mpp, idx, ap):
+    # Like MATRIX, returns a sparse matrix A and a K x 2 matrix b
+    # for the x- and y-axes.
     EPSILON = 1e-9
     K = len(idx)
+    # Collect (row, col, value) triplets; duplicates are summed when
+    # the matrix is assembled at the end.
+    rows = []
+    cols = []
+    vals = []
     # Fill A with E_stable
-    A = scipy.sparse.diags([np.ones(K) * EPSILON], [0], (K,K), "dok")
-    b = np.zeros(K)
-    j = 0
+    rows.append(np.arange(K))
+    cols.append(np.arange(K))
+    vals.append(np.ones(K) * EPSILON)
+    b = np.zeros((K, 2))
     # Next, add E_point
     for mp in mpp:
+        if len(mp.xx1)==0:
+            continue
         if mp.s1==mp.s2 and mp.r1==mp.r2:
             w = 50
         else:
             w = 5
-        for n in range(len(mp.xx1)):
-            p = idx[(mp.r1, mp.m1, mp.s1, mp.kk1[n])]
-            pp = idx[(mp.r2, mp.m2, mp.s2, mp.kk2[n])]
-            Dx = mp.xp(ax)[n] - mp.x(ax)[n]
-            #print(f'point {mp.r1},{mp.m1},{mp.s1}:{mp.r2},{mp.m2},{mp.s2} {mp.xx1[n]},{mp.yy1[n]} [{ax}]: {Dx}') 
-            A[p,p] += w
-            A[pp,pp] += w
-            A[p,pp] -= w
-            A[pp,p] -= w
-            b[p] += w*Dx
-            b[pp] -= w*Dx
+        p = np.array([idx[(mp.r1, mp.m1, mp.s1, k)] for k in mp.kk1])
+        pp = np.array([idx[(mp.r2, mp.m2, mp.s2, k)] for k in mp.kk2])
+        r, c, v = _springs(p, pp, np.ones(len(p)) * w)
+        rows.append(r)
+        cols.append(c)
+        vals.append(v)
+        for ax in range(2):
+            Dx = mp.xp(ax) - mp.x(ax)
+            b[:,ax] += np.bincount(p, w*Dx, K) - np.bincount(pp, w*Dx, K)
     # Finally, add E_elast
     Q = 4
     def distfoo(dist2):
         D0 = 684 # Anything within D0 px should be taken very seriously
         return 1/(dist2/(D0*D0) + .1)
-    for mp in mpp:
-        rms = (mp.r1, mp.m1, mp.s1)
-        xx = ap[rms][0]
-        yy = ap[rms][1]
-        for n in range(len(mp.xx1)):
-            k = mp.kk1[n]
-            #print('TEST', mp, n, k, xx[k], mp.xx1[n])
-            dx = xx[k] - xx
-            dy = yy[k] - yy
-            dst = dx**2 + dy**2
-            # Now, we need to find the Q points with least dst, not
-            # counting k itself.
-            if len(dst)>Q+1:
-                kk = np.argpartition(dst, Q+1)
-                kk = kk[:Q+1]
-            else:
-                kk = np.arange(len(dst))
-            kk = kk[kk!=k]
-            p = idx[(mp.r1, mp.m1, mp.s1, k)]
-            for kstar in kk:
-                pstar = idx[(mp.r1, mp.m1, mp.s1, kstar)]
-                w = distfoo(dst[kstar])
-                A[p,p] += w
-                A[pstar,pstar] += w
-                A[p,pstar] -= w
-                A[pstar,p] -= w
-                #print(f'elast {mp.r1},{mp.m1},{mp.s1}:{mp.r2},{mp.m2},{mp.s2} {mp.xx1[n]},{mp.yy1[n]}+{dx[kstar]},{dy[kstar]} [{ax}]: {w}') 
-
-        rms = (mp.r2, mp.m2, mp.s2)
-        xx = ap[rms][0]
-        yy = ap[rms][1]
-        for n in range(len(mp.xx2)):
-            k = mp.kk2[n]
-            dx = xx[k] - xx
-            dy = yy[k] - yy
-            dst = dx**2 + dy**2
-            # Now, we need to find the Q points with least dst, not
-            # counting k itself.
-            kk = np.argsort(dst)
-            kk = kk[1:]
-            if len(kk)>Q:
-                kk = kk[:Q]
-            p = idx[(mp.r2, mp.m2, mp.s2, k)]
-            for kstar in kk:
-                pstar = idx[(mp.r2, mp.m2, mp.s2, kstar)]
-                w = distfoo(dst[kstar])
-                A[p,p] += w
-                A[pstar,pstar] += w
-                A[p,pstar] -= w
-                A[pstar,p] -= w
+    tilep = {} # Map from (r,m,s) to vector of p indexed by k
+    for rmsk,p in idx.items():
+        rms = rmsk[0], rmsk[1], rmsk[2]
+        if rms not in tilep:
+            tilep[rms] = np.zeros(len(ap[rms][0]), dtype=int)
+        tilep[rms][rmsk[3]] = p
+    for rms, pk in tilep.items():
+        # Connect each point to the Q points nearest to it in its tile,
+        # not counting itself.
+        N = len(pk)
+        if N<2:
+            continue
+        xy = np.stack((ap[rms][0], ap[rms][1]), 1)
+        dst, kstar = scipy.spatial.cKDTree(xy).query(xy, min(Q+1, N))
+        k = np.repeat(np.arange(N).reshape(N,1), kstar.shape[1], 1)
+        # Normally, each point is its own nearest neighbor, but with
+        # duplicate points that need not be so.
+        use = kstar != k
+        use = np.logical_and(use, np.cumsum(use, 1) <= Q)
+        r, c, v = _springs(pk[k[use]], pk[kstar[use]], distfoo(dst[use]**2))
+        rows.append(r)
+        cols.append(c)
+        vals.append(v)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    vals = np.concatenate(vals)
+    A = scipy.sparse.coo_matrix((vals, (rows, cols)), (K,K)).tocsr()
     return A, b
-    
@@ -8,23 +8,21 @@ from pathlib import Path
 def produceq25(r, m, s, ofn=None):
     print('Working on Q25 run %i montage %i slice %i' % (r,m,s)) 
     ifn = rawimage.rawtile(r, m, s)
-    img = rawimage.loadimage(ifn)
-    img = rawimage.iscale(img, 5)
     if r==25 and s>140:
-        img = rawimage.to8bit(img, .1, 15000)
+        ignorethr = 15000
     else:
-        img = rawimage.to8bit(img, .1)
+        ignorethr = None
+    # Read the raw tile exactly once: everything downstream is derived
+    # from the 16-bit Q5 image and the histograms gathered on the way.
+    img, hst5, hst1 = rawimage.iscalestream(ifn, 5)
+    img = rawimage.contrastlut(hst5, .1, ignorethr)[img]
 
-    # Create 5x5 subtiles at 1/5th
-    Y,X = img.shape
-    R = Y//5
+    # Store the whole tile at 1/5th in a single memory-mappable file
+    # rather than as 5x5 subtiles
     ofntmpl = Path(rawimage.scaledtile(r, m, s, 5))
     copro.ensuredirfor(str(ofntmpl))
-    for x in range(5):
-        for y in range(5):
-            imti = img[R*y:R*(y+1), R*x:R*(x+1)]
-            ofnti = str(ofntmpl.with_suffix('.%i%i.tif' % (x, y)))
-            rawimage.saveimage(imti, ofnti)
+    rawimage.saveq5store(img, r, m, s)
+    rawimage.savetilehist(r, m, s, hst1, hst5)
     ofntmpl.with_suffix('.complete').touch()
 
     img = rawimage.iscale(img, 5)
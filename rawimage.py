@@ -5,6 +5,9 @@ import cv2
 import config
 import re
 import os
+import threading
+import collections
+import concurrent.futures
 
 def rawtile(r, m, s):
     '''RAWTILE - Filename for raw image
@@ -30,6 +33,13 @@ def partialq5tile(r, m, s, ix, iy):
     to 4 inclusive.'''
     return f'{config.root}/scaled/Q5/R{r}/M{m}/S{s}.{ix}{iy}.tif'
 
+def q5storefile(r, m, s):
+    '''Q5STOREFILE - Filename for memory-mappable Q5 tile
+    fn = Q5STOREFILE(r, m, s) returns the path of the file that holds
+    the entire scaled raw tile of run/montage/slice at Q5 as a single
+    uncompressed 3420x3420-pixel 8-bit image in numpy (.npy) format.'''
+    return f'{config.root}/scaled/Q5/R{r}/M{m}/S{s}.npy'
+
 def loadimage(url):
     '''LOADIMAGE - Download an image from anywhere
     img = LOADIMAGE(url) downloads an image from anywhere.
@@ -53,22 +63,26 @@ def loadimage(url):
 def loadlocaltif(fn):
     return cv2.imread(fn, cv2.IMREAD_ANYDEPTH + cv2.IMREAD_GRAYSCALE)
 
-def ihist(img):
+def ihist(img, ignorethr=None):
     '''IHIST - Calculate image histogram
     hst = IHIST(img) where IMG is either an 8-bit or a 16-bit image, calculates
     the image histogram. The result is a vector with 256 or 65536 entries.
     Histogram calculation is surprisingly slow for large images, despite
-    the use of opencv.'''
+    the use of opencv.
+    If optional argument IGNORETHR is given, pixels blacker than that
+    value are not counted.'''
+    if ignorethr is not None:
+        img = img[img>=ignorethr]
     if img.dtype==np.uint8:
         hst = cv2.calcHist([img], [0], None, [256], [0, 256])
-        return hst[:,0]
+        return hst.ravel()
     elif img.dtype==np.uint16:
         hst = cv2.calcHist([img], [0], None, [65536], [0, 65536])
-        return hst[:,0]
+        return hst.ravel()
     else:
         raise ValueError('Only 8 or 16 bit images are supported')
 
-def to8bit(img, stretch=.1, ignorethr=None, subst=None):
+def to8bit(img, stretch=.1, ignorethr=None, subst=None, hst=None):
     '''TO8BIT - Convert 16-bit image to 8 bits
     im8 = TO8BIT(im16) converts a 16-bit image to 8-bit format, clipping
     extreme values.
@@ -83,36 +97,15 @@ def to8bit(img, stretch=.1, ignorethr=None, subst=None):
     value are ignored in the histogram calculation. Furthermore, if SUBST
     is given, those ignored pixels are assigned output value SUBST.
     Calling TO8BIT on an 8-bit image has no effect; the contrast is not
-    stretched in that case and substitutions are not applied.'''
+    stretched in that case and substitutions are not applied.
+    If the histogram of the image is already known (e.g., from TILEHIST),
+    it may be passed as HST to save recalculating it.'''
     if img.dtype==np.uint8:
         return img
     elif img.dtype==np.uint16:
-        if ignorethr is None:
-            hst = cv2.calcHist([img], [0], None, [65536], [0, 65536])
-        else:
-            hst = cv2.calcHist([img[img>=ignorethr]], [0], None, [65536],
-                               [0, 65536])
-        hst = np.cumsum(hst)
-        scl = hst[-1]
-        if type(stretch)==dict:
-            if len(stretch)!=2:
-                raise ValueError('Must have exactly two percentiles')
-            kk = list(stretch.keys())
-            kk.sort()
-            p1 = np.searchsorted(hst, .01*kk[0]*scl)
-            p2 = np.searchsorted(hst, .01*kk[1]*scl)
-            v1 = stretch[kk[0]]
-            v2 = stretch[kk[1]]
-        else:
-            p1 = np.searchsorted(hst, .01*stretch*scl)
-            p2 = np.searchsorted(hst, (1-.01*stretch)*scl)
-            v1 = 0
-            v2 = 256
-        lut = np.arange(65536)
-        lut = v1 + (v2-v1) * (lut - p1) / (1 + p2 - p1)
-        lut[lut<0] = 0
-        lut[lut>255] = 255
-        lut = lut.astype(np.uint8)
+        if hst is None:
+            hst = ihist(img)
+        lut = contrastlut(hst, stretch, ignorethr)
         res = lut[img]
         if subst is not None:
             res[img<ignorethr] = subst
@@ -120,6 +113,37 @@ def to8bit(img, stretch=.1, ignorethr=None, subst=None):
     else:
         raise ValueError('Only 8 or 16 bit images are supported')
 
+def contrastlut(hst, stretch=.1, ignorethr=None):
+    '''CONTRASTLUT - Lookup table for conversion to 8 bits
+    lut = CONTRASTLUT(hst, stretch) where HST is a 65536-bin histogram
+    (as from IHIST) returns the lookup table that TO8BIT would apply to
+    the image with that histogram. STRETCH and IGNORETHR are as for TO8BIT.
+    Apply the result to a 16-bit image as LUT[img].'''
+    if ignorethr is not None:
+        hst = np.array(hst)
+        hst[:ignorethr] = 0
+    hst = np.cumsum(hst)
+    scl = hst[-1]
+    if type(stretch)==dict:
+        if len(stretch)!=2:
+            raise ValueError('Must have exactly two percentiles')
+        kk = list(stretch.keys())
+        kk.sort()
+        p1 = np.searchsorted(hst, .01*kk[0]*scl)
+        p2 = np.searchsorted(hst, .01*kk[1]*scl)
+        v1 = stretch[kk[0]]
+        v2 = stretch[kk[1]]
+    else:
+        p1 = np.searchsorted(hst, .01*stretch*scl)
+        p2 = np.searchsorted(hst, (1-.01*stretch)*scl)
+        v1 = 0
+        v2 = 256
+    lut = np.arange(65536)
+    lut = v1 + (v2-v1) * (lut - p1) / (1 + p2 - p1)
+    lut[lut<0] = 0
+    lut[lut>255] = 255
+    return lut.astype(np.uint8)
+
 def iscale(img, n):
     '''ISCALE - Downscale an image
     im = ISCALE(img, n) downscales the image IMG by a factor N in both
@@ -131,6 +155,49 @@ def iscale(img, n):
         img = img[0:n*Ky,0:n*Kx]
     return cv2.resize(img, (Kx, Ky), interpolation=cv2.INTER_AREA)
 
+def openraw(fn):
+    '''OPENRAW - Access a raw image without necessarily loading it
+    img = OPENRAW(fn) returns a read-only memory map of the 16-bit TIFF
+    file FN, so that only the parts that are actually used get read.
+    Files that cannot be memory-mapped (e.g., compressed files, or if the
+    tifffile module is not available) are loaded in full instead.'''
+    try:
+        import tifffile
+        return tifffile.memmap(fn, mode='r')
+    except (ImportError, ValueError):
+        img = loadimage(fn)
+        if img is None:
+            raise ValueError(f'Cannot read {fn}')
+        return img
+
+def iscalestream(fn, n, bandrows=500):
+    '''ISCALESTREAM - Downscale an image file band by band
+    img, hst, rawhst = ISCALESTREAM(fn, n) reads a 16-bit TIFF file and
+    downscales it by a factor N in both directions, like ISCALE. It also
+    returns the histograms of the downscaled image (HST) and of the
+    original image (RAWHST), like IHIST.
+    The file is opened with OPENRAW and processed in bands of about
+    BANDROWS source rows, so that only one band is read into memory at
+    a time.'''
+    src = openraw(fn)
+    Y,X = src.shape
+    Ky = Y//n
+    Kx = X//n
+    B = max(1, bandrows//n) # Output rows per band
+    img = np.empty((Ky,Kx), dtype=np.uint16)
+    hst = np.zeros(65536, dtype=np.int64)
+    rawhst = np.zeros(65536, dtype=np.int64)
+    for y0 in range(0, Y, n*B):
+        band = np.asarray(src[y0:y0+n*B], dtype=np.uint16)
+        rawhst += ihist(band).astype(np.int64)
+        y1 = min(y0//n + B, Ky)
+        if y1 > y0//n:
+            img[y0//n:y1,:] = cv2.resize(band[:n*(y1-y0//n), :n*Kx],
+                                         (Kx, y1-y0//n),
+                                         interpolation=cv2.INTER_AREA)
+            hst += ihist(img[y0//n:y1,:]).astype(np.int64)
+    return img, hst, rawhst
+
 def ipad(img, pad=512, padc=0):
     '''IPAD - Pad an image
     im = IPAD(img, pad) zero pads an image so that its size is an integral
@@ -175,11 +242,214 @@ def betaimg(z, a=6):
     print(x0, y0, w, h, url)
     return loadimage(url)
 
+class ImageCache:
+    '''IMAGECACHE - Thread-safe LRU cache of decoded images
+    cache = IMAGECACHE(maxbytes) creates a cache that holds at most
+    MAXBYTES worth of pixels. Images are dropped least-recently-used first.
+    Images stored in the cache are made read-only, because they are shared
+    between all users.'''
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.imgs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        '''GET - Retrieve an image from the cache
+        img = GET(key, loader) returns the image stored under KEY, or,
+        if there is none, calls LOADER() to load the image and stores it.
+        Images that fail to load (None) are not stored.'''
+        with self.lock:
+            if key in self.imgs:
+                self.imgs.move_to_end(key)
+                self.hits += 1
+                return self.imgs[key]
+            self.misses += 1
+        img = loader()
+        if img is None or img.nbytes > self.maxbytes:
+            return img
+        img.setflags(write=False)
+        with self.lock:
+            if key not in self.imgs:
+                self.imgs[key] = img
+                self.nbytes += img.nbytes
+            while self.nbytes > self.maxbytes:
+                k, im = self.imgs.popitem(last=False)
+                self.nbytes -= im.nbytes
+        return img
+
+    def resize(self, maxbytes):
+        '''RESIZE - Change the memory budget of the cache'''
+        with self.lock:
+            self.maxbytes = maxbytes
+            while self.nbytes > self.maxbytes:
+                k, im = self.imgs.popitem(last=False)
+                self.nbytes -= im.nbytes
+
+    def clear(self):
+        '''CLEAR - Drop all images from the cache'''
+        with self.lock:
+            self.imgs.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''STATS - Cache performance
+        hits, misses, nbytes = STATS() returns the number of cache hits
+        and misses so far, and the number of bytes currently stored.'''
+        with self.lock:
+            return self.hits, self.misses, self.nbytes
+
+q5cache = ImageCache(1024**3) # Holds about 2000 Q5 subtiles
+
+def saveq5store(img, r, m, s):
+    '''SAVEQ5STORE - Save a full Q5 tile in memory-mappable form
+    SAVEQ5STORE(img, r, m, s) saves the 3420x3420-pixel image IMG to
+    Q5STOREFILE(r, m, s). The file is written under a temporary name
+    and then renamed, so readers never see a partial file.'''
+    ofn = q5storefile(r, m, s)
+    with open(ofn + '.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(img, dtype=np.uint8))
+    os.replace(ofn + '.tmp', ofn)
+
+def q5store(r, m, s):
+    '''Q5STORE - Memory-map a full Q5 tile
+    img = Q5STORE(r, m, s) returns a read-only memory map of the file
+    saved by SAVEQ5STORE, or None if there is no such file.'''
+    fn = q5storefile(r, m, s)
+    if not os.path.exists(fn):
+        return None
+    return np.load(fn, mmap_mode='r')
+
+def histfile(r, m, s):
+    '''HISTFILE - Filename for raw tile histograms
+    fn = HISTFILE(r, m, s) returns the path of the file that holds the
+    intensity histograms of the raw tile of run/montage/slice at Q1 and Q5.'''
+    return f'{config.root}/scaled/Q5/R{r}/M{m}/S{s}.hist.npz'
+
+def savetilehist(r, m, s, hst1, hst5=None):
+    '''SAVETILEHIST - Save intensity histograms for a raw tile
+    SAVETILEHIST(r, m, s, hst1, hst5) saves the 65536-bin histograms of
+    the raw tile at Q1 and Q5 to HISTFILE(r, m, s). These are unthresholded:
+    CONTRASTLUT can apply any IGNORETHR later.
+    HST5 may be omitted, in which case only the Q1 histogram is saved.'''
+    ofn = histfile(r, m, s)
+    hh = { 'q1': np.asarray(hst1, dtype=np.int64) }
+    if hst5 is not None:
+        hh['q5'] = np.asarray(hst5, dtype=np.int64)
+    os.makedirs(os.path.dirname(ofn), exist_ok=True)
+    with open(ofn + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **hh)
+    os.replace(ofn + '.tmp', ofn)
+
+def tilehist(r, m, s, q=1):
+    '''TILEHIST - Load saved intensity histogram for a raw tile
+    hst = TILEHIST(r, m, s, q) returns the histogram saved by SAVETILEHIST
+    for scale Q (1 or 5), or None if there is none.'''
+    fn = histfile(r, m, s)
+    if not os.path.exists(fn):
+        return None
+    with np.load(fn) as f:
+        if f'q{q}' not in f:
+            return None
+        return f[f'q{q}']
+
+lutcache = ImageCache(64*1024**2) # Holds about 1000 lookup tables
+
+def tilelut(r, m, s, stretch=.1, ignorethr=None):
+    '''TILELUT - Contrast lookup table for a raw tile
+    lut = TILELUT(r, m, s, stretch, ignorethr) returns the lookup table
+    that TO8BIT(img, stretch, ignorethr) would use for the raw tile of
+    run/montage/slice, based on the histogram saved by SAVETILEHIST.
+    Returns None if there is no saved histogram. Results are cached in
+    LUTCACHE.'''
+    if type(stretch)==dict:
+        skey = tuple(sorted(stretch.items()))
+    else:
+        skey = stretch
+    def loader():
+        hst = tilehist(r, m, s, 1)
+        if hst is None:
+            return None
+        return contrastlut(hst, stretch, ignorethr)
+    return lutcache.get((r, m, s, skey, ignorethr), loader)
+
 def partialq5img(r, m, s, ix, iy):
-    return loadimage(partialq5tile(r, m, s, ix, iy))
+    '''PARTIALQ5IMG - Load a scaled raw subtile
+    img = PARTIALQ5IMG(r, m, s, ix, iy) returns the given subtile at Q5,
+    or None if it does not exist. If there is a Q5STORE for the tile,
+    the result is a view into that; otherwise, the subtile is loaded from
+    its own file and cached in Q5CACHE. Either way, the resulting image
+    is read-only.'''
+    full = q5store(r, m, s)
+    if full is not None:
+        X = 684
+        return full[iy*X:(iy+1)*X, ix*X:(ix+1)*X]
+    return q5cache.get((r, m, s, ix, iy),
+                       lambda: loadimage(partialq5tile(r, m, s, ix, iy)))
+
+_prefetcher = None
+_prefetchpid = None
+_prefetchlock = threading.Lock()
+
+def _prefetchpool():
+    # One pool of loader threads shared by all walks in this process
+    global _prefetcher, _prefetchpid
+    with _prefetchlock:
+        if _prefetchpid != os.getpid():
+            _prefetcher = concurrent.futures.ThreadPoolExecutor(16)
+            _prefetchpid = os.getpid()
+        return _prefetcher
+
+def _prefetchq5(r, m, s, ix, iy):
+    try:
+        img = partialq5img(r, m, s, ix, iy)
+    except Exception as e:
+        print(e)
+        return np.zeros((684,684), dtype=np.uint8) + 128
+    if img is not None:
+        # Views into a Q5STORE are only read when touched; do that here
+        img = np.array(img)
+        img.setflags(write=False)
+    return img
+
+def q5walk(r, m, ix, iy, ss, depth=4):
+    '''Q5WALK - Iterate over a subtile through a sequence of slices
+    for s, img in Q5WALK(r, m, ix, iy, ss): ... yields subtile (IX, IY) of
+    run/montage R/M for each slice S in SS, as PARTIALQ5IMG would return
+    it. Up to DEPTH subtiles beyond the current one are loaded in
+    background threads, so that file latency overlaps with whatever the
+    caller does with the current image.
+    If loading a subtile fails with an exception, the exception is
+    printed and a uniform gray image is yielded instead.'''
+    pool = _prefetchpool()
+    pending = collections.deque()
+    ss = iter(ss)
+    try:
+        for s in ss:
+            pending.append((s, pool.submit(_prefetchq5, r, m, s, ix, iy)))
+            if len(pending) > depth:
+                s, fut = pending.popleft()
+                yield s, fut.result()
+        while len(pending):
+            s, fut = pending.popleft()
+            yield s, fut.result()
+    finally:
+        for s, fut in pending:
+            fut.cancel()
 
 def q5subimg2x2(r, m, s, ix, iy):
+    '''Q5SUBIMG2X2 - Load 2x2 scaled raw subtiles
+    img = Q5SUBIMG2X2(r, m, s, ix, iy) returns the 1368x1368-pixel
+    image made up of subtiles (ix-1, iy-1) through (ix, iy).
+    IX and IY must be in the range 1..4.'''
+    if ix<1 or ix>4 or iy<1 or iy>4:
+        raise ValueError(f'Subtile {ix},{iy} is not in range 1..4')
     X = 684
+    full = q5store(r, m, s)
+    if full is not None:
+        return full[(iy-1)*X:(iy+1)*X, (ix-1)*X:(ix+1)*X]
     img = np.zeros((X*2, X*2), dtype=np.uint8)
     img[:X,:X] = partialq5img(r,m,s,ix-1,iy-1)
     img[:X,X:] = partialq5img(r,m,s,ix,iy-1)
@@ -188,6 +458,12 @@ def q5subimg2x2(r, m, s, ix, iy):
     return img
 
 def fullq5img(r, m, s):
+    '''FULLQ5IMG - Load an entire scaled raw tile
+    img = FULLQ5IMG(r, m, s) returns the 3420x3420-pixel tile at Q5,
+    or None if (any part of) it does not exist.'''
+    full = q5store(r, m, s)
+    if full is not None:
+        return full
     X = 684
     img = np.zeros((5*X,5*X), dtype=np.uint8)
     for ix in range(5):
@@ -201,11 +477,38 @@ def fullq5img(r, m, s):
 def q25img(r, m, s):
     return loadimage(scaledtile(r, m, s, 25))
 
+def rawq1img(r, m, s, stretch=.1, ignorethr=None):
+    '''RAWQ1IMG - Raw tile along with its contrast lookup table
+    img, lut = RAWQ1IMG(r, m, s, stretch, ignorethr) returns the raw 16-bit
+    tile as from OPENRAW, along with the lookup table that FULLQ1IMG would
+    apply to it. LUT[img[y0:y1,x0:x1]] then converts just part of the
+    tile to 8 bits. Returns (None, None) if the tile does not exist.
+    If the tile has no saved histogram yet, it is calculated and saved.'''
+    ifn = rawtile(r, m, s)
+    if not os.path.exists(ifn):
+        return None, None
+    img = openraw(ifn)
+    lut = tilelut(r, m, s, stretch, ignorethr)
+    if lut is None:
+        hst = np.zeros(65536, dtype=np.int64)
+        for y0 in range(0, img.shape[0], 500):
+            band = np.asarray(img[y0:y0+500], dtype=np.uint16)
+            hst += ihist(band).astype(np.int64)
+        savetilehist(r, m, s, hst)
+        lut = contrastlut(hst, stretch, ignorethr)
+    return img, lut
+
 def fullq1img(r, m, s, stretch=.1, ignorethr=None):
     ifn = rawtile(r, m, s)
     if not os.path.exists(ifn):
         return None
+    lut = tilelut(r, m, s, stretch, ignorethr)
     img = loadimage(ifn)
-    return to8bit(img, stretch, ignorethr)
+    if lut is None:
+        # Tile predates saved histograms: calculate it once and keep it
+        hst = ihist(img)
+        savetilehist(r, m, s, hst)
+        return to8bit(img, stretch, ignorethr, hst=hst)
+    return lut[img]
 
     
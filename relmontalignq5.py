@@ -17,6 +17,7 @@ import sys
 import traceback
 
 import swiftir
+import swimbatch
 import pyqplot as qp
 import numpy as np
 
@@ -50,86 +51,75 @@ def maketable():
     syb float,
     snrb float
     )''')
+    # Number of swim runs actually done; the second may be skipped
+    # (see swimbatch.converged). Null for rows from before that existed.
+    db.exe('''alter table relmontalignq5 add column if not exists npass integer''')
 
 ri = db.runinfo()
 
-def alignsubtiles(r, m, s, ix, iy, tileimg, neighborhoodimg):
+SIZ = (512, 512)
+SHP = (SIZ[1], SIZ[0]) # Shape of the windows
+
+def centerspectrum(img):
+    # Spectrum of the apodized central window of a subtile. Each subtile
+    # is used against both of its neighboring slices, so this is
+    # calculated only once per subtile.
+    if img is None:
+        return None
+    Y,X = img.shape
+    win = swiftir.extractStraightWindow(img, (X/2,Y/2), SIZ)
+    return swimbatch.spectra(swimbatch.apodize(win[None]))
+
+def alignsubtiles(r, m, s, ix, iy, tileimg, neighborhoodimg, ff1, ff2):
     print(f'Working on r{r} m{m} s{s} {ix},{iy}')
     if neighborhoodimg is None:
-        db.exe(f'''insert into relmontalignq5 
-        (r,m,s,ix,iy,
-        dx,dy,sx,sy,snr, dxb,dyb,sxb,syb,snrb)
-        values
-        ({r},{m},{s},{ix},{iy},
-        0,0,0,0,1000,
-        0,0,0,0,1000)''')
+        sink.add(r,m,s,ix,iy, 0,0,0,0,1000, 0,0,0,0,1000, 0)
         return
     
     Y,X = tileimg.shape
-    SIZ = (512, 512)
-    win1 = swiftir.extractStraightWindow(tileimg, (X/2,Y/2), SIZ)
-    win2 = swiftir.extractStraightWindow(neighborhoodimg, (X/2,Y/2), SIZ)
-
-    apo1 = swiftir.apodize(win1)
-    apo2 = swiftir.apodize(win2)
-    (dx, dy, sx, sy, snr) = swiftir.swim(apo1, apo2)
+    res = swimbatch.swimspectra(ff1, ff2, SHP)
+    (dx, dy, sx, sy, snr) = res[0]
+    if swimbatch.converged(res, SIZ)[0]:
+        sink.add(r,m,s,ix,iy, *res[0], *swimbatch.skipped(res)[0], 1)
+        return
 
+    # The second pass moves both windows by half the shift, so that the
+    # match stays centered on the subtile as MATCHPOINTSQ5 assumes. The
+    # reference window is therefore not the same as in the first pass,
+    # and its spectrum cannot be reused.
     win1 = swiftir.extractStraightWindow(tileimg, (X/2-dx/2,Y/2-dy/2), SIZ)
     win2 = swiftir.extractStraightWindow(neighborhoodimg, (X/2+dx/2,Y/2+dy/2), SIZ)
+    (dxb, dyb, sxb, syb, snrb) = swimbatch.swim(win1[None], win2[None])[0]
 
-    apo1 = swiftir.apodize(win1)
-    apo2 = swiftir.apodize(win2)
-    (dxb, dyb, sxb, syb, snrb) = swiftir.swim(apo1, apo2)
-
-    db.exe(f'''insert into relmontalignq5 
-    (r,m,s,ix,iy,
-    dx,dy,sx,sy,snr, dxb,dyb,sxb,syb,snrb)
-    values
-    ({r},{m},{s},{ix},{iy},
-    {dx},{dy},{sx},{sy},{snr}, 
-    {dxb},{dyb},{sxb},{syb},{snrb})''')
+    sink.add(r,m,s,ix,iy, dx,dy,sx,sy,snr, dxb,dyb,sxb,syb,snrb, 2)
         
 def alignmanysubtiles(r, m, ix, iy):
-    cnt = db.sel(f'''select count(1) from relmontalignq5 
-    where r={r} and m={m} and ix={ix} and iy={iy}''')[0][0]
-    if cnt==ri.nslices(r):
+    if done.count(r, m, ix, iy)==ri.nslices(r):
         return
-    def loader(subtileid):
-        r,m,s,ix,iy = subtileid
-        try:
-            img = rawimage.partialq5img(r,m,s,ix,iy)
-        except Exception as e:
-            print(e)
-            img = np.zeros((684,684), dtype=np.uint8) + 128
-        return img 
-            
-    def saver(subtileid, tileimg, neighborhoodimg):
-        r,m,s,ix,iy = subtileid
-        alignsubtiles(r, m, s, ix, iy, tileimg, neighborhoodimg)
-
-    ssdone = set()
-    for row in db.sel(f'''select s from relmontalignq5
-           where r={r} and m={m} and ix={ix} and iy={iy}'''):
-        ssdone.add(int(row[0]))
+    ssdone = set(s for s in range(ri.nslices(r))
+                 if done.count(r, m, ix, iy, s))
 
-    lastimg = None
+    # Slices to align, plus their predecessors
+    ss = set()
     for s in range(ri.nslices(r)):
-        if s in ssdone:
-            lastimg = None
-        else:
-            subtileid = (r,m,s,ix,iy)
-            img = loader(subtileid)
-            if s>0 and lastimg is None:
-                lastimg = loader((r,m,s-1,ix,iy))
-            saver(subtileid, img, lastimg)
-            lastimg = img
+        if s not in ssdone:
+            ss.add(s)
+            if s>0:
+                ss.add(s-1)
+
+    lastimg = None
+    lastff = None
+    for s, img in rawimage.q5walk(r, m, ix, iy, sorted(ss)):
+        ff = centerspectrum(img)
+        if s not in ssdone:
+            alignsubtiles(r, m, s, ix, iy, img, lastimg, ff, lastff)
+        lastimg = img
+        lastff = ff
 
 fac = factory.Factory(nthreads)
     
 def queuealignmanysubtiles(r, m, ix, iy):
-    cnt = db.sel(f'''select count(1) from relmontalignq5 
-    where r={r} and m={m} and ix={ix} and iy={iy}''')[0][0]
-    if cnt==ri.nslices(r):
+    if done.count(r, m, ix, iy)==ri.nslices(r):
         return
     fac.request(alignmanysubtiles, r, m, ix, iy)
 
@@ -139,20 +129,24 @@ def queuealignmontage(r, m):
             queuealignmanysubtiles(r, m, ix, iy)
 
 maketable()
+done = db.done('relmontalignq5', ['r', 'm', 'ix', 'iy', 's'])
+sink = db.sink('relmontalignq5',
+               ['r', 'm', 's', 'ix', 'iy',
+                'dx', 'dy', 'sx', 'sy', 'snr',
+                'dxb', 'dyb', 'sxb', 'syb', 'snrb', 'npass'],
+               done=done)
     
 for r0 in range(ri.nruns()):
     r  = r0 + 1
-    cnt = db.sel(f'select count(1) from relmontalignq5 where r={r}')
-    if cnt[0][0]==ri.nmontages(r)*ri.nslices(r)*5*5:
+    if done.count(r)==ri.nmontages(r)*ri.nslices(r)*5*5:
         continue
     for m in range(ri.nmontages(r)):
-        cnt = db.sel(f'''select count(1) from relmontalignq5 
-          where r={r} and m={m}''')
-        if cnt[0][0]==ri.nslices(r)*5*5:
+        if done.count(r, m)==ri.nslices(r)*5*5:
             continue
 
         queuealignmontage(r, m)
 
 print(f'Waiting for factory to complete tasks')
-fac.shutdown()    
+fac.shutdown()
+sink.close()    
         
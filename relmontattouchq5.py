@@ -20,6 +20,7 @@ import sys
 import traceback
 
 import swiftir
+import swimbatch
 import pyqplot as qp
 import numpy as np
 
@@ -62,6 +63,9 @@ def maketable():
     syb float,
     snrb float
     )''')
+    # Number of swim runs actually done; the second may be skipped
+    # (see swimbatch.converged). Null for rows from before that existed.
+    db.exe('''alter table relmontattouchq5 add column if not exists npass integer''')
 
 ri = db.runinfo()
 
@@ -86,52 +90,39 @@ def alignsubtiles(subtileid, m2, row, tileimg, neighborhoodimg):
     win1 = swiftir.extractStraightWindow(tileimg, (x,y), SIZ)
     # print('shape', win1.shape)
     win2 = swiftir.extractStraightWindow(neighborhoodimg, (x,y), SIZ)
-    apo1 = swiftir.apodize(win1)
-    apo2 = swiftir.apodize(win2)
+    apo1 = swimbatch.apodize(win1[None])
+    apo2 = swimbatch.apodize(win2[None])
 
     if SHOW:
         qp.figure('/tmp/s1', 8, 4)
         qp.subplot(1,2,1)
-        qp.imsc(apo1)
+        qp.imsc(apo1[0])
         Y1,X1 = win1.shape
         qp.at(X1/2,Y1/2)
         qp.pen('b')
         qp.text(f'{ix},{iy} {dx0}/{dy0}: {SIZ}')
         qp.shrink(1,1)
         qp.subplot(1,2,2)
-        qp.imsc(apo2)
+        qp.imsc(apo2[0])
         qp.shrink(1,1)
         #time.sleep(.5)
     
-    (dx, dy, sx, sy, snr) = swiftir.swim(apo1, apo2)
+    res = swimbatch.swimspectra(swimbatch.spectra(apo1),
+                                swimbatch.spectra(apo2), apo1.shape[1:])
+    (dx, dy, sx, sy, snr) = res[0]
+    if swimbatch.converged(res, SIZ)[0]:
+        sink.add(r,m,s,ix,iy,x,y,m2, *res[0], *swimbatch.skipped(res)[0], 1)
+        return
 
+    # As in RELMONTALIGNQ5, the second pass moves both windows, so the
+    # first window cannot be reused
     win1 = swiftir.extractStraightWindow(tileimg, (x-dx/2,y-dy/2), SIZ)
     win2 = swiftir.extractStraightWindow(neighborhoodimg, (x+dx/2,y+dy/2), SIZ)
-    apo1b = swiftir.apodize(win1)
-    apo2b = swiftir.apodize(win2)
-    (dxb, dyb, sxb, syb, snrb) = swiftir.swim(apo1b, apo2b)
-    db.exe(f'''delete from relmontattouchq5 
-      where r={r} and m={m} and m2={m2} and s={s} and ix={ix} and iy={iy}''')
-    db.exe(f'''insert into relmontattouchq5 
-    (r,m,s,ix,iy,x,y,m2,
-    dx,dy,sx,sy,snr, dxb,dyb,sxb,syb,snrb)
-    values
-    ({r},{m},{s},{ix},{iy},{x},{y},{m2},
-    {dx},{dy},{sx},{sy},{snr}, 
-    {dxb},{dyb},{sxb},{syb},{snrb})''')
+    (dxb, dyb, sxb, syb, snrb) = swimbatch.swim(win1[None], win2[None])[0]
+    sink.add(r,m,s,ix,iy,x,y,m2, dx,dy,sx,sy,snr, dxb,dyb,sxb,syb,snrb, 2)
         
 def alignmanysubtiles(r, m, m2, ii, ix, iy):
     print(f'Working on R{r} M{m}:{m2} {ii} / {ix},{iy}')
-    def loader(subtileid):
-        r,m,s,ii,ix,iy = subtileid
-        print(f'loading r{r} m{m} s{s} ix{ix} iy{iy}')
-        try:
-            img = rawimage.partialq5img(r,m,s,ix,iy)
-        except Exception as e:
-            print(e)
-            img = np.zeros((684,684), dtype=np.uint8) + 128
-        return img 
-            
     def saver(subtileid, tileimg, neighborhoodimg):
         r,m,s,ii,ix,iy = subtileid
         rows1 = db.sel(f'''select
@@ -148,43 +139,36 @@ def alignmanysubtiles(r, m, m2, ii, ix, iy):
             alignsubtiles(subtileid, m2, row, tileimg, neighborhoodimg)
 
     # Figure out what slices have to be done
-    ssdone = set()
-    for row in db.sel(f'''select s from relmontattouchq5
-       where r={r} and m={m} and m2={m2} and ix={ix} and iy={iy}'''):
-        s = row[0]
-        ssdone.add(s)
+    ssdone = set(s for s in range(ri.nslices(r))
+                 if done.count(r, m, m2, ix, iy, s))
     
-    lastimg = None
+    # Slices to align, plus their predecessors
+    ss = set()
     for s in range(1, ri.nslices(r)):
-        if s in ssdone:
-            lastimg = None
-        else:
-            img = loader((r,m,s,ii,ix,iy))
-            if lastimg is None:
-                lastimg = loader((r,m,s-1,ii,ix,iy))
+        if s not in ssdone:
+            ss.add(s)
+            ss.add(s-1)
+
+    lastimg = None
+    for s, img in rawimage.q5walk(r, m, ix, iy, sorted(ss)):
+        if s>0 and s not in ssdone:
             saver((r,m,s,ii,ix,iy), img, lastimg)
-            lastimg = img
+        lastimg = img
 
 fac = factory.Factory(nthreads)
     
 def queuealignmanysubtiles(r, m, m2, ii, ix, iy):
-    cnt = db.sel(f'''select count(1) from relmontattouchq5 
-        where r={r} and m={m} and m2={m2} and ix={ix} and iy={iy}''')[0][0]
-    cnt1 = db.sel(f'''select count(1) from slicealignq5
-        where r={r} and m1={m} and m2={m2} and ii={ii} and s=0''')[0][0]
-    cnt2 = db.sel(f'''select count(1) from slicealignq5
-        where r={r} and m2={m} and m1={m2} and ii={ii} and s=0''')[0][0]
+    cnt = done.count(r, m, m2, ix, iy)
+    cnt1 = crossdone.count(r, m, m2, ii)
+    cnt2 = crossdone.count(r, m2, m, ii)
     if cnt == (cnt1 + cnt2)*(ri.nslices(r)-1):
         return
     fac.request(alignmanysubtiles, r, m, m2, ii, ix, iy)
 
 def queuealignmontagepair(r, m, m2, iifix):
-    cnt = db.sel(f'''select count(1) from relmontattouchq5
-    where r={r} and m={m} and m2={m2}''')
-    cnt1 = db.sel(f'''select count(1) from slicealignq5
-    where r={r} and m1={m} and m2={m2} and s=0''')[0][0]
-    cnt2 = db.sel(f'''select count(1) from slicealignq5
-    where r={r} and m2={m} and m1={m2} and s=0''')[0][0]
+    cnt = done.count(r, m, m2)
+    cnt1 = crossdone.count(r, m, m2)
+    cnt2 = crossdone.count(r, m2, m)
     if cnt==(cnt1+cnt2) * (ri.nslices(r)-1):
         return
     
@@ -213,19 +197,27 @@ def queuealignmontage(r, m):
 
 #droptable()
 maketable()
+done = db.done('relmontattouchq5', ['r', 'm', 'm2', 'ix', 'iy', 's'])
+crossdone = db.done('slicealignq5', ['r', 'm1', 'm2', 'ii'], 's=0')
+# Existing rows for a given (r, m, m2, s, ix, iy) are replaced
+sink = db.sink('relmontattouchq5',
+               ['r', 'm', 's', 'ix', 'iy', 'x', 'y', 'm2',
+                'dx', 'dy', 'sx', 'sy', 'snr',
+                'dxb', 'dyb', 'sxb', 'syb', 'snrb', 'npass'],
+               keys=['r', 'm', 'm2', 's', 'ix', 'iy'],
+               done=done)
     
 for r0 in range(50, ri.nruns()):
     r  = r0 + 1
     print(f'Considering R{r}')
-    cnt = db.sel(f'''select count(1) from relmontattouchq5 
-    where r={r}''')[0][0]
-    cnt1 = db.sel(f'''select count(1) from slicealignq5
-    where r={r} and s=0''')[0][0]
+    cnt = done.count(r)
+    cnt1 = crossdone.count(r)
     if cnt==2*cnt1*(ri.nslices(r)-1):
         continue
     for m in range(ri.nmontages(r)):
         queuealignmontage(r, m)
 
 print(f'Waiting for factory to end')
-fac.shutdown()    
+fac.shutdown()
+sink.close()
         
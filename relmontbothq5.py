@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+
+# This does the work of RELMONTALIGNQ5 and RELMONTATTOUCHQ5 in a single
+# pass. Each subtile is loaded once per slice and aligned against the
+# previous slice both at its center (into table RELMONTALIGNQ5) and at
+# the positions along montage edges found by SLICEALIGNQ5 (into table
+# RELMONTATTOUCHQ5). The tables are exactly as those programs write them,
+# so either can still be used to redo its own half of the work.
+# Note that I am _not_ scaling the dx, dy, etc. coordinates back up to Q1.
+
+import aligndb
+import time
+import sys
+import traceback
+
+import swiftir
+import swimbatch
+import numpy as np
+
+import rawimage
+import factory
+
+nthreads = 12
+
+db = aligndb.DB()
+
+def maketables():
+    db.exe('''create table if not exists relmontalignq5 (
+    r integer,
+    m integer,
+    s integer,
+    ix integer,
+    iy integer,
+
+    dx float,
+    dy float,
+    sx float,
+    sy float,
+    snr float,
+
+    dxb float,
+    dyb float,
+    sxb float,
+    syb float,
+    snrb float
+    )''')
+    # Number of swim runs actually done; the second may be skipped
+    # (see swimbatch.converged). Null for rows from before that existed.
+    db.exe('''alter table relmontalignq5 add column if not exists npass integer''')
+    db.exe('''create table if not exists relmontattouchq5 (
+    r integer,
+    m integer,
+    s integer,
+    ix integer,
+    iy integer,
+    x float,
+    y float,
+    m2 integer,
+
+    dx float,
+    dy float,
+    sx float,
+    sy float,
+    snr float,
+
+    dxb float,
+    dyb float,
+    sxb float,
+    syb float,
+    snrb float
+    )''')
+    # Number of swim runs actually done; the second may be skipped
+    # (see swimbatch.converged). Null for rows from before that existed.
+    db.exe('''alter table relmontattouchq5 add column if not exists npass integer''')
+
+ri = db.runinfo()
+
+SIZ = (512, 512)
+SHP = (SIZ[1], SIZ[0]) # Shape of the windows
+
+def centerspectrum(img):
+    # Spectrum of the apodized central window of a subtile, as in
+    # RELMONTALIGNQ5
+    if img is None:
+        return None
+    Y,X = img.shape
+    win = swiftir.extractStraightWindow(img, (X/2,Y/2), SIZ)
+    return swimbatch.spectra(swimbatch.apodize(win[None]))
+
+def aligncenter(r, m, s, ix, iy, tileimg, neighborhoodimg, ff1, ff2):
+    print(f'Working on r{r} m{m} s{s} {ix},{iy}')
+    if neighborhoodimg is None:
+        centersink.add(r,m,s,ix,iy, 0,0,0,0,1000, 0,0,0,0,1000, 0)
+        return
+    Y,X = tileimg.shape
+    res = swimbatch.swimspectra(ff1, ff2, SHP)
+    (dx, dy, sx, sy, snr) = res[0]
+    if swimbatch.converged(res, SIZ)[0]:
+        centersink.add(r,m,s,ix,iy, *res[0], *swimbatch.skipped(res)[0], 1)
+        return
+
+    # The second pass moves both windows by half the shift, so that the
+    # match stays centered on the subtile as MATCHPOINTSQ5 assumes. The
+    # reference window is therefore not the same as in the first pass,
+    # and its spectrum cannot be reused.
+    win1 = swiftir.extractStraightWindow(tileimg, (X/2-dx/2,Y/2-dy/2), SIZ)
+    win2 = swiftir.extractStraightWindow(neighborhoodimg, (X/2+dx/2,Y/2+dy/2), SIZ)
+    (dxb, dyb, sxb, syb, snrb) = swimbatch.swim(win1[None], win2[None])[0]
+
+    centersink.add(r,m,s,ix,iy, dx,dy,sx,sy,snr, dxb,dyb,sxb,syb,snrb, 2)
+
+def aligntouches(r, m, s, ix, iy, m2, xy, tileimg, neighborhoodimg):
+    # Aligns at all the positions XY (in montage coordinates) along the
+    # edge with M2 in one batch per pass
+    print(f'Working on r{r} m{m}:{m2} s{s} {ix},{iy}')
+    Y,X = tileimg.shape
+    if m2==ri.mleft(r,m) or m2==ri.mright(r,m):
+        siz = (X//4, Y//2)
+    elif m2==ri.mabove(r,m) or m2==ri.mbelow(r,m):
+        siz = (X//2, Y//4)
+    else:
+        raise ValueError('Surprising pair')
+    xy = np.array(xy) - [X*ix, Y*iy]
+    N = len(xy)
+
+    win1 = swimbatch.extract([tileimg]*N, xy, siz)
+    win2 = swimbatch.extract([neighborhoodimg]*N, xy, siz)
+    res = swimbatch.swim(win1, win2)
+
+    npass = np.ones(N, dtype=int)
+    run = ~swimbatch.converged(res, siz)
+    resb = swimbatch.skipped(res)
+    if np.any(run):
+        dxy = res[:,:2]
+        win1 = swimbatch.extract([tileimg]*N, xy - dxy/2, siz)
+        win2 = swimbatch.extract([neighborhoodimg]*N, xy + dxy/2, siz)
+        resb[run] = swimbatch.swim(win1[run], win2[run])
+        npass[run] = 2
+
+    for k in range(N):
+        touchsink.add(r,m,s,ix,iy,xy[k,0],xy[k,1],m2,
+                      *res[k], *resb[k], npass[k])
+
+def touches(r, m, ix, iy):
+    # Returns a list of (m2, ii) for all the montage edges that subtile
+    # (ix, iy) lies on
+    tt = []
+    if ix==0 and ri.mleft(r, m) is not None:
+        tt.append((ri.mleft(r, m), iy))
+    if ix==4 and ri.mright(r, m) is not None:
+        tt.append((ri.mright(r, m), iy))
+    if iy==0 and ri.mabove(r, m) is not None:
+        tt.append((ri.mabove(r, m), ix))
+    if iy==4 and ri.mbelow(r, m) is not None:
+        tt.append((ri.mbelow(r, m), ix))
+    return tt
+
+def touchpositions(r, m, m2, ii):
+    # Returns a dict mapping slice number to list of (x, y) positions
+    # in montage M that SLICEALIGNQ5 found to touch montage M2
+    xyy = {}
+    rows = db.sel(f'''select s,
+          x1-dx/2-dxb/2-dxc/2,y1-dy/2-dyb/2-dyc/2
+          from slicealignq5
+          where r={r} and m1={m} and m2={m2} and ii={ii}''')
+    rows += db.sel(f'''select s,
+          x2+dx/2+dxb/2+dxc/2,y2+dy/2+dyb/2+dyc/2
+          from slicealignq5
+          where r={r} and m2={m} and m1={m2} and ii={ii}''')
+    for s, x, y in rows:
+        if int(s) not in xyy:
+            xyy[int(s)] = []
+        xyy[int(s)].append((x, y))
+    return xyy
+
+def slicesdone(done, *key):
+    # Slices for which DONE has rows with the given key prefix
+    return set(s for s in range(ri.nslices(key[0])) if done.count(*key, s))
+
+def touchcount(r, m, ix, iy):
+    # Number of RELMONTATTOUCHQ5 rows expected for subtile (ix, iy)
+    cnt = 0
+    for m2, ii in touches(r, m, ix, iy):
+        cnt += (crossdone.count(r, m, m2, ii) + crossdone.count(r, m2, m, ii))
+    return cnt * (ri.nslices(r)-1)
+
+def isdone(r, m, ix, iy):
+    if centerdone.count(r, m, ix, iy) < ri.nslices(r):
+        return False
+    cnt = sum(touchdone.count(r, m, m2, ix, iy)
+              for m2, ii in touches(r, m, ix, iy))
+    return cnt >= touchcount(r, m, ix, iy)
+
+def alignmanysubtiles(r, m, ix, iy):
+    if isdone(r, m, ix, iy):
+        return
+    S = ri.nslices(r)
+    cdone = slicesdone(centerdone, r, m, ix, iy)
+    tt = touches(r, m, ix, iy)
+    tdone = {}
+    txyy = {}
+    for m2, ii in tt:
+        tdone[m2] = slicesdone(touchdone, r, m, m2, ix, iy)
+        txyy[m2] = touchpositions(r, m, m2, ii)
+
+    def needcenter(s):
+        return s>=0 and s<S and s not in cdone
+    def needtouch(s, m2):
+        return s>=1 and s<S and s not in tdone[m2] and s in txyy[m2]
+    def needed(s):
+        return needcenter(s) or any(needtouch(s, m2) for m2, ii in tt)
+
+    # Slices to align, plus their predecessors
+    ss = set()
+    for s in range(S):
+        if needed(s):
+            ss.add(s)
+            if s>0:
+                ss.add(s-1)
+
+    lastimg = None
+    lastff = None
+    for s, img in rawimage.q5walk(r, m, ix, iy, sorted(ss)):
+        if needcenter(s) or needcenter(s+1):
+            ff = centerspectrum(img)
+        else:
+            ff = None
+        if needcenter(s):
+            aligncenter(r, m, s, ix, iy, img, lastimg, ff, lastff)
+        for m2, ii in tt:
+            if needtouch(s, m2):
+                aligntouches(r, m, s, ix, iy, m2, txyy[m2][s], img, lastimg)
+        lastimg = img
+        lastff = ff
+
+fac = factory.Factory(nthreads)
+
+def queuealignmanysubtiles(r, m, ix, iy):
+    if isdone(r, m, ix, iy):
+        return
+    fac.request(alignmanysubtiles, r, m, ix, iy)
+
+def queuealignmontage(r, m):
+    for ix in range(5):
+        for iy in range(5):
+            queuealignmanysubtiles(r, m, ix, iy)
+
+maketables()
+centerdone = db.done('relmontalignq5', ['r', 'm', 'ix', 'iy', 's'])
+touchdone = db.done('relmontattouchq5', ['r', 'm', 'm2', 'ix', 'iy', 's'])
+crossdone = db.done('slicealignq5', ['r', 'm1', 'm2', 'ii'], 's=0')
+centersink = db.sink('relmontalignq5',
+                     ['r', 'm', 's', 'ix', 'iy',
+                      'dx', 'dy', 'sx', 'sy', 'snr',
+                      'dxb', 'dyb', 'sxb', 'syb', 'snrb', 'npass'],
+                     done=centerdone)
+# Existing rows for a given (r, m, m2, s, ix, iy) are replaced
+touchsink = db.sink('relmontattouchq5',
+                    ['r', 'm', 's', 'ix', 'iy', 'x', 'y', 'm2',
+                     'dx', 'dy', 'sx', 'sy', 'snr',
+                     'dxb', 'dyb', 'sxb', 'syb', 'snrb', 'npass'],
+                    keys=['r', 'm', 'm2', 's', 'ix', 'iy'],
+                    done=touchdone)
+
+for r0 in range(ri.nruns()):
+    r  = r0 + 1
+    print(f'Considering R{r}')
+    for m in range(ri.nmontages(r)):
+        queuealignmontage(r, m)
+
+print(f'Waiting for factory to complete tasks')
+fac.shutdown()
+centersink.close()
+touchsink.close()
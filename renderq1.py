@@ -10,6 +10,7 @@ import rawimage
 import warp
 import sys
 import config
+import threading
 
 tbl = 'renderq1done'
 odir = f'{config.root}/q1pyramid'
@@ -33,116 +34,184 @@ def maketable():
     )''')
     db.exe(f'''create index if not exists {tbl}_z on {tbl} (z)''')
 
+STRETCH = {50: 130, 75: 172}
+IGNORETHR = 5000
+A = 9 # Number of pyramid levels
+
+# Raw tiles that cannot be memory-mapped are loaded in full (see
+# RAWIMAGE.OPENRAW), at about 585 MB each. At most MAXFULLLOADS of those
+# are kept from one band to the next, counting all slices being rendered
+# at once. Any others are loaded again for each band that needs them.
+MAXFULLLOADS = 4
+_fullloads = threading.Semaphore(MAXFULLLOADS)
+
 def render(z):
+    # The slice is rendered one band of TS rows at a time, and each band
+    # is passed up the pyramid as soon as it is complete, so that only a
+    # couple of bands per level are ever in memory.
     print(f'Rendering z{z}')
     X = TS*((W*Q + TS-1) // TS)
     Y = TS*((H*Q + TS-1) // TS)
-    img = np.zeros((Y,X), dtype=np.uint8)
     r, s = ri.findz(z)
     M = ri.nmontages(r)
+
+    # Plan all the montages
+    plan = renderq5utils.renderplan(r, s)
+    grids = [] # Tuples (m, xx, yy, xtile, ytile) in Q1 coords
     xx0 = []
     yy0 = []
     for m in range(M):
-        print(f'Loading Z{z} M{m}')
-        #tile = rawimage.fullq1img(r, m, s, stretch=2.0)
-        tile = rawimage.fullq1img(r, m, s, 
-                                  stretch={50: 130, 75: 172},
-                                  ignorethr=5000)
-        if tile is None:
+        if not os.path.exists(rawimage.rawtile(r, m, s)):
             print(f'Not rendering Z{z} M{m} - No image')
             continue
-        #print(f'Replacing 0 by 1 in Z{z} M{m}')
-        tile[tile==0] = 1
-        #print(f'Processing Z{z} M{m}')
-        xx, yy = renderq5utils.rendergrid(r, m, s)
-        IX = len(xx) - 1
-        IY = len(yy) - 1
-        x0, y0 = renderq5utils.rigidtileposition(r, m, s)
-        xx0.append(x0)
-        yy0.append(y0)
-        fac = factory.Factory(7)
-        def renderone(ix, iy):
-            #print(f'Rendering Z{z} M{m} IX{ix} IY{iy}')
-            xl1 = xx[ix]
-            xr1 = xx[ix+1]
-            yt1 = yy[iy]
-            yb1 = yy[iy+1]
-            if xr1<=xl1 or yb1<=yt1:
-                print(f'Nothing to render for Z{z} M{m} IX{ix} IY{iy}')
-                return
-            xywh = [xl1*Q, yt1*Q, (xr1-xl1)*Q, (yb1-yt1)*Q]
-            xmdl = np.array([xx[ix], xx[ix], xx[ix+1], xx[ix+1]])
-            ymdl = np.array([yy[iy], yy[iy+1], yy[iy], yy[iy+1]])
-            dx, dy = renderq5utils.interpolatedshifts(r, m, s, xmdl, ymdl)
-            xtile = xmdl - (x0 + dx)
-            ytile = ymdl - (y0 + dy)
-            warp.warpToRectangle(img, xywh, tile,
-                                 xmdl*Q, ymdl*Q,
-                                 xtile*Q, ytile*Q)
-        for ix in range(IX):
-            for iy in range(IY):
-                fac.request(renderone, ix, iy)
-        fac.shutdown()
-    dr = f'{odir}/Z{z//100}'
-    if not os.path.exists(dr):
-        os.mkdir(dr)
-    dr += f'/{z%100}'
-    if not os.path.exists(dr):
-        os.mkdir(dr)
-
-    img1 = img
-    # Find extent actually filled
+        grid = renderq5utils.plannedtile(plan, m)
+        if grid is None:
+            # Do not render a slice with a hole in it; it will be retried
+            raise Exception(f'No elastic solution for Z{z} M{m}')
+        xx, yy, xtile, ytile = grid
+        xx0.append(plan['x0'][m])
+        yy0.append(plan['y0'][m])
+        grids.append((m, xx*Q, yy*Q, xtile*Q, ytile*Q))
+    if len(grids)==0:
+        print(f'Nothing to render for Z{z}')
+        return
+    lastrow = {} # Last row in Q1 space needed from each montage
+    for m, xx, yy, *_ in grids:
+        lastrow[m] = np.max(yy)
+
+    # Find extent actually filled, at each level
     x0 = int(np.floor(np.min(xx0)*Q))
     y0 = int(np.floor(np.min(yy0)*Q))
     x1 = int(np.ceil(np.max(xx0)*Q + FS))
     y1 = int(np.ceil(np.max(yy0)*Q + FS))
-    for a in range(9):
-        print(f'Saving Z{z} A{a}')
-        dr1 = dr + f'/A{a}'
-        if not os.path.exists(dr1):
-            os.mkdir(dr1)
-        x0t = x0 // TS
-        y0t = y0 // TS
-        x1t = (x1+TS-1) // TS
-        y1t = (y1+TS-1) // TS
-        print(f'Tile range X{x0t}:{x1t} Y{y0t}:{y1t}')
-        def saveone(x, y, dr2, img1): # x and y are tile numbers!
-            #print(f'Saving Z{z} A{a} X{x} Y{y}')
-            xl = x*TS
-            xr = xl + TS
-            yt = y*TS
-            yb = yt + TS
-            img2 = img1[yt:yb, xl:xr]
-            #print(f'Z{z} A{a} X{x} Y{y}', xl,yt,img1.shape,
-            #      img2.shape,np.mean(img2))
-            if not cv2.imwrite(f'{dr2}/X{x}.jpg', img2):
-                print(f'Failed to save Z{z} A{a} X{x} Y{y}')
-                sys.exit(1)
-        fac = factory.Factory(8)
-        for yt in range(y0t, y1t):
-            dr2 = dr1 + f'/Y{yt}'
-            if not os.path.exists(dr2):
-                os.mkdir(dr2)
-            for xt in range(x0t, x1t):
-                fac.request(saveone, xt, yt, dr2, img1)
-        fac.shutdown()
+    extent = []
+    for a in range(A):
+        extent.append((x0 // TS, y0 // TS, (x1+TS-1) // TS, (y1+TS-1) // TS))
         x0 = x0 // 2
         y0 = y0 // 2
         x1 = (x1 + 1) // 2
         y1 = (y1 + 1) // 2
-        img1 = rawimage.iscale(img1, 2)
-        #print(f'Z{z} A{a} Image scaled to ', img1.shape)
-        img1 = rawimage.ipad(img1, TS)
-        #print(f'Z{z} A{a} Image padded to ', img1.shape)
+
+    dr = f'{odir}/Z{z//100}/{z%100}'
+    def saveone(a, x, y, img2): # x and y are tile numbers!
+        #print(f'Saving Z{z} A{a} X{x} Y{y}')
+        if not cv2.imwrite(f'{dr}/A{a}/Y{y}/X{x}.jpg', img2):
+            print(f'Failed to save Z{z} A{a} X{x} Y{y}')
+            sys.exit(1)
+    savefac = factory.Factory(8)
+
+    pending = [None] * A # Even band at each level waiting for its partner
+    nrows = [Y // TS]
+    for a in range(1, A):
+        nrows.append((nrows[-1] + 1) // 2)
+    def emit(a, yt, band):
+        # Called with each complete band of tile row YT at level A
+        x0t, y0t, x1t, y1t = extent[a]
+        if yt>=y0t and yt<y1t:
+            os.makedirs(f'{dr}/A{a}/Y{yt}', exist_ok=True)
+            for xt in range(x0t, x1t):
+                savefac.request(saveone, a, xt, yt,
+                                band[:, xt*TS:(xt+1)*TS])
+        if a+1 >= A:
+            return
+        if yt % 2 == 0:
+            pending[a] = band
+            if yt < nrows[a] - 1:
+                return
+            band = np.zeros_like(band) # Odd number of rows: pad
+        both = np.concatenate((pending[a], band), 0)
+        pending[a] = None
+        emit(a+1, yt//2, rawimage.ipad(rawimage.iscale(both, 2), TS))
+
+    sources = {}
+    held = set() # Montages with full-load fallbacks that hold a slot
+    transient = set() # Montages with full-load fallbacks that do not
+    def source(m):
+        if m not in sources:
+            print(f'Loading Z{z} M{m}')
+            sources[m] = rawimage.rawq1img(r, m, s, STRETCH, IGNORETHR)
+            tile = sources[m][0]
+            if tile is not None and not isinstance(tile, np.memmap):
+                if _fullloads.acquire(blocking=False):
+                    held.add(m)
+                else:
+                    transient.add(m)
+        return sources[m]
+
+    def dropsource(m):
+        del sources[m]
+        if m in held:
+            held.remove(m)
+            _fullloads.release()
+        transient.discard(m)
+
+    def crop(m, x0, y0, x1, y1):
+        # Part of the tile converted to 8 bits, avoiding zeros, which
+        # mark the absence of data
+        tile, lut = sources[m]
+        sub = lut[tile[y0:y1, x0:x1]]
+        sub[sub==0] = 1
+        return sub
+
+    def renderquad(band, by0, m, xx, yy, xtile, ytile, ix, iy):
+        # Renders the part of one quad that falls within the band
+        x = xx[ix]
+        w = xx[ix+1] - x
+        yt = max(yy[iy], by0)
+        yb = min(yy[iy+1], by0+TS)
+        xmdl, ymdl, ximg, yimg = warp.gridQuad(xx, yy, xtile, ytile, ix, iy)
+        mdl2img = warp.getPerspective(xmdl, ymdl, ximg, yimg)
+        xl0, yt0, xr0, yb0 = warp.quadToImageBox(np.array([x, x+w, x, x+w]),
+                                                 np.array([yt, yt, yb, yb]),
+                                                 mdl2img, sources[m][0].shape)
+        if xr0<=xl0 or yb0<=yt0:
+            return
+        warp.warpToRectangle(band, (x, yt-by0, w, yb-yt),
+                             crop(m, xl0, yt0, xr0, yb0),
+                             xmdl, ymdl - by0, ximg - xl0, yimg - yt0)
+
+    fac = factory.Factory(7)
+    try:
+        for yt in range(nrows[0]):
+            by0 = yt*TS
+            band = np.zeros((TS, X), dtype=np.uint8)
+            futs = []
+            for m, xx, yy, xtile, ytile in grids:
+                if np.min(yy) >= by0+TS or np.max(yy) <= by0:
+                    continue
+                source(m)
+                for ix in range(len(xx) - 1):
+                    for iy in range(len(yy) - 1):
+                        if xx[ix+1]<=xx[ix] or yy[iy+1]<=yy[iy]:
+                            continue
+                        if yy[iy] < by0+TS and yy[iy+1] > by0:
+                            futs.append(fac.request(renderquad, band, by0,
+                                                    m, xx, yy, xtile, ytile,
+                                                    ix, iy))
+            for fut in factory.ascompleted(futs):
+                pass
+            # Drop montages that are not needed for any later band, as
+            # well as full loads that could not get a slot
+            for m in list(sources.keys()):
+                if lastrow[m] <= by0+TS or m in transient:
+                    dropsource(m)
+            emit(0, yt, band)
+    finally:
+        for m in list(sources.keys()):
+            dropsource(m)
+    fac.shutdown()
+    savefac.shutdown()
     db.exe(f'insert into {tbl} (z) values ({z})')
+    done.add(z)
 
 def perhapsrender(z):
-    if db.sel(f'select count(1) from {tbl} where z={z}')[0][0]==0:
+    if done.count(z)==0:
         render(z)
 
 if not(os.path.exists(odir)):
     os.mkdir(odir)
 maketable()    
+done = db.done(tbl, ['z'])
 
 fac0 = factory.Factory(4)
 for z in range(4,9604):
@@ -9,6 +9,7 @@ import os
 import rawimage
 import warp
 import sys
+import traceback
 import config
 
 tbl = 'renderq5elasticdone'
@@ -34,16 +35,20 @@ def render(z):
     img = np.zeros((H,W), dtype=np.uint8)
     r, s = ri.findz(z)
     M = ri.nmontages(r)
+    plan = renderq5utils.renderplan(r, s)
     for m in range(M):
         print(f'Rendering Z{z} M{m}')
         tile = rawimage.fullq5img(r, m, s)
         if tile is None:
             print(f'Not rendering Z{z} M{m} - No image')
             continue
-        xx, yy = renderq5utils.rendergrid(r, m, s)
+        grid = renderq5utils.plannedtile(plan, m)
+        if grid is None:
+            # Do not render a slice with a hole in it; it will be retried
+            raise Exception(f'No elastic solution for Z{z} M{m}')
+        xx, yy, xtile, ytile = grid
         IX = len(xx) - 1
         IY = len(yy) - 1
-        x0, y0 = renderq5utils.rigidtileposition(r, m, s)
         for ix in range(IX):
             for iy in range(IY):
                 #print(f'Rendering Z{z} M{m} IX{ix} IY{iy}')
@@ -54,26 +59,40 @@ def render(z):
                 if xr1 <= xl1 or yb1 <= yt1:
                     continue
                 xywh = [xl1, yt1, xr1-xl1, yb1-yt1]
-                xmdl = np.array([xx[ix], xx[ix], xx[ix+1], xx[ix+1]])
-                ymdl = np.array([yy[iy], yy[iy+1], yy[iy], yy[iy+1]])
-                dx, dy = renderq5utils.interpolatedshifts(r, m, s, xmdl, ymdl)
-                xtile = xmdl - x0 - dx
-                ytile = ymdl - y0 - dy
-                warp.warpToRectangle(img, xywh, tile, xmdl, ymdl, xtile, ytile)
+                warp.warpToRectangle(img, xywh, tile,
+                                     *warp.gridQuad(xx, yy, xtile, ytile,
+                                                    ix, iy))
     dr = f'{odir}/Z{z//100}'
     if not(os.path.exists(dr)):
         os.mkdir(dr)
     fn = f'{dr}/{z%100}.jpg'
     cv2.imwrite(fn, img)
     db.exe(f'insert into {tbl} (z) values ({z})')
+    done.add(z)
     
 def perhapsrender(z):
-    if db.sel(f'select count(1) from {tbl} where z={z}')[0][0]==0:
+    if done.count(z)==0:
         render(z)
 
+def renderblock(z0):
+    # Renders the 100 slices from z0 in order. Each worker process has its
+    # own cache of subvolumes (see RENDERQ5UTILS.SUBVOLUME), so handing out
+    # whole blocks means that each worker loads only the two subvolumes
+    # that the block needs, rather than every worker loading every
+    # subvolume.
+    # A slice that fails is reported and left undone, without stopping
+    # the rest of the block.
+    for z in range(z0, min(z0+100, 9604)):
+        try:
+            perhapsrender(z)
+        except Exception as e:
+            traceback.print_exc()
+            print(f'Failed to render Z{z}: {e}')
+
 if not(os.path.exists(odir)):
     os.mkdir(odir)
 maketable()    
+done = db.done(tbl, ['z'])
 args = sys.argv
 args.pop(0)
 if len(args)>0:
@@ -81,8 +100,8 @@ if len(args)>0:
     z = int(a)
     render(z)
 else: 
-  fac = factory.Factory(12)
-  for z in range(4,9604):
-    fac.request(perhapsrender, z)
+  fac = factory.Factory(12, processes=True)
+  for z0 in range(4,9604,100):
+    fac.request(renderblock, z0)
   fac.shutdown()
   
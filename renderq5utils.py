@@ -2,6 +2,11 @@
 
 import aligndb
 import numpy as np
+import config
+import os
+import threading
+import tempfile
+import collections
 
 monttbl = 'solveq5mont'
 rigidtbl = 'solveq5rigidtile'
@@ -16,24 +21,80 @@ ri = db.runinfo()
 
 bbox = db.sel(f'select x0,y0,x1,y1 from {bboxtbl}')[0]
 
-_glsh = {} # Our collection of global shifts
+MAXSUBVOLUMES = 4 # Number of subvolumes that SUBVOLUME keeps in memory
+
+_subvols = collections.OrderedDict() # Loaded subvolumes, most recent last
+_subvollock = threading.Lock()
+
+def _groups(keys):
+    # Given a list of equal-length integer vectors, sorted lexicographically,
+    # returns a dict mapping each distinct key tuple to a slice of rows
+    N = len(keys[0])
+    if N==0:
+        return {}
+    chg = np.zeros(N-1, dtype=bool)
+    for k in keys:
+        chg |= k[1:] != k[:-1]
+    starts = np.concatenate(([0], np.flatnonzero(chg) + 1))
+    ends = np.concatenate((starts[1:], [N]))
+    return { tuple(int(k[a]) for k in keys): slice(a, b)
+             for a, b in zip(starts, ends) }
+
+def _loadsubvolume(z0):
+    x, y = db.sel(f'select x, y from {globtbl} where z0={z0}')[0]
+    gx = x - bbox[0]
+    gy = y - bbox[1]
+    rr, ss, mm, xm, ym = db.vsel(f'''select ri.r, ri.s, ri.m,
+    mo.x+ri.x, mo.y+ri.y
+    from {monttbl} as mo
+    inner join {rigidtbl} as ri on mo.z0=ri.z0 and mo.r=ri.r and mo.m=ri.m
+    where ri.z0={z0}
+    order by ri.r, ri.s, ri.m''')
+    rigid = {}
+    for rs, sl in _groups([rr, ss]).items():
+        rigid[rs] = (xm[sl] + gx, ym[sl] + gy)
+    rr, mm, ss, x, y, dx, dy = db.vsel(f'''select r, m, s, x, y, dx, dy
+    from {elastbl} where z0={z0}
+    order by r, m, s''')
+    elastic = {}
+    for rms, sl in _groups([rr, mm, ss]).items():
+        elastic[rms] = (x[sl] + gx, y[sl] + gy, dx[sl], dy[sl])
+    return { 'shift': (gx, gy),
+             'rigid': rigid,
+             'elastic': elastic }
+
+def subvolume(z0):
+    '''SUBVOLUME - Rigid and elastic solutions for an entire subvolume
+    sv = SUBVOLUME(z0) returns a dict with the following entries:
+      shift - (x, y) global shift for the subvolume, as from GLOBALSHIFT
+      rigid - dict mapping (r, s) to vectors (xm, ym), as from
+              RIGIDTILEPOSITIONS
+      elastic - dict mapping (r, m, s) to vectors (x, y, dx, dy), as from
+                SHIFTCOLLECTION.
+    The first time a subvolume is requested, all of its data are loaded
+    with a single query per table. The MAXSUBVOLUMES most recently used
+    subvolumes are kept in memory. Since WHENCE refers to at most two
+    subvolumes for any z, and rendering proceeds through z in order, that
+    way subvolumes are dropped once rendering has moved past them.'''
+    with _subvollock:
+        if z0 in _subvols:
+            _subvols.move_to_end(z0)
+            return _subvols[z0]
+        sv = _loadsubvolume(z0)
+        _subvols[z0] = sv
+        while len(_subvols) > MAXSUBVOLUMES:
+            _subvols.popitem(last=False)
+        return sv
+
 def globalshift(z0):
     '''GLOBALSHIFT - Global shift to be added to within-subvolume positions.
     x, y = GLOBALSHIFT(z0) returns the shift to be added to subvolume-local
     coordinates to get global coordinates.
     Note: These coordinates are shifted so that they are nonnegative by 
     definition, thanks to the use of the global q5bbox.
-    The results are cached in memory, so database lookup is performed only
-    the first time a given subvolume is requested.'''
-    if z0 in _glsh:
-        return _glsh[z0]
-    x, y = db.sel(f'select x, y from {globtbl} where z0={z0}')[0]
-    x -= bbox[0]
-    y -= bbox[1]
-    _glsh[z0] = (x, y)
-    return x, y
+    The results are cached in memory by SUBVOLUME.'''
+    return subvolume(z0)['shift']
 
-_rtp = {}
 def rigidtilepositions(z0, r, s):
     '''RIGIDTILEPOSITIONS - Truly global positions of tiles
     xm, ym = RIGIDTILEPOSITIONS(z0, r, s) returns the truly global
@@ -41,22 +102,11 @@ def rigidtilepositions(z0, r, s):
     run r according to the subvolume at z0. 
     Note: These coordinates are shifted so that they are nonnegative by 
     definition, thanks to the use of the global q5bbox.
-    The results are cached in memory, so database lookup is performed only
-    the first time a given slice is requested.'''
-    zrs = (z0,r,s)
-    if zrs in _rtp:
-        return _rtp[zrs]
-    
-    xm, ym = db.vsel(f'''select mo.x+ri.x, mo.y+ri.y
-    from {monttbl} as mo
-    inner join {rigidtbl} as ri on mo.z0=ri.z0 and mo.r=ri.r and mo.m=ri.m
-    where ri.z0={z0} and ri.r={r} and ri.s={s} 
-    order by ri.m''')
-    gs = globalshift(z0)
-    xm += gs[0]
-    ym += gs[1]
-    _rtp[zrs] = (xm, ym)
-    return xm, ym
+    The results are cached in memory by SUBVOLUME. Do not modify them.'''
+    rigid = subvolume(z0)['rigid']
+    if (r,s) not in rigid:
+        return np.array([]), np.array([])
+    return rigid[(r,s)]
 
 def globalbbox():
     '''GLOBALBBOX - Overall bounding box of imagery
@@ -81,13 +131,12 @@ def shiftcollection(z0, r, m, s):
     '''SHIFTCOLLECTION - Known shifts according to elastic solution
     x, y, dx, dy = SHIFTCOLLECTION(z0, r, m, s) returns all the known 
     shifts for the given (r,m,s). X, Y are returned as truly global
-    coordinates. Shifts DX, DY are relative to rigid placement.'''
-    gx, gy = globalshift(z0)
-    x, y, dx, dy = db.vsel(f'''select x, y, dx, dy from {elastbl}
-    where z0={z0} and r={r} and m={m} and s={s}''')
-    x += gx
-    y += gy
-    return x, y, dx, dy
+    coordinates. Shifts DX, DY are relative to rigid placement.
+    The results are cached in memory by SUBVOLUME. Do not modify them.'''
+    elastic = subvolume(z0)['elastic']
+    if (r,m,s) not in elastic:
+        return np.array([]), np.array([]), np.array([]), np.array([])
+    return elastic[(r,m,s)]
 
 def whence(z):
     '''WHENCE - Which subvolumes to use to render a given z-plane
@@ -180,10 +229,12 @@ def rigidtileposition(r, m, s, collapse=True):
     else:
         return x, y, ww
 
-def renderlimits(r, m, s):
+def renderlimits(r, m, s, touch=None):
     '''RENDERLIMITS - Boundaries for rendering of tiles in q5elastic
     xl, yt, xr, yb = RENDERLIMITS(r, m, s) returns the limits [xl, xr) and
-    [yt, yb) for rendering the given tile.'''
+    [yt, yb) for rendering the given tile.
+    Optional argument TOUCH may be the result of TOUCHLINES(r, s), to
+    avoid recalculating it for every tile in a slice.'''
 
     # Our aim is to find the common area covered by all rigid positionings
     # of the tile.    
@@ -198,7 +249,9 @@ def renderlimits(r, m, s):
     R = ri.nrows(r)
     col = m % C
     row = m // C
-    tox, toy = touchlines(r, s)
+    if touch is None:
+        touch = touchlines(r, s)
+    tox, toy = touch
     if col<C-1:
         rx = tox[row, col]
     if col>0:
@@ -209,12 +262,15 @@ def renderlimits(r, m, s):
         ty = toy[row-1]
     return lx,ty,rx,by
 
-def rendergrid(r, m, s):
+def rendergrid(r, m, s, limits=None):
     '''RENDERGRID - Return grid points in global space for rendering a tile
     xx, yy = RENDERGRID(r, m, s) returns a vector of x-coordinates and
     a vector of y-coordinates in global space that mark a grid and bbox
-    of space to be filled by the given tile.'''
-    lx, ty, rx, by = renderlimits(r, m, s)
+    of space to be filled by the given tile.
+    Optional argument LIMITS may be the result of RENDERLIMITS(r, m, s).'''
+    if limits is None:
+        limits = renderlimits(r, m, s)
+    lx, ty, rx, by = limits
     xrig, yrig, ww = rigidtileposition(r, m, s, collapse=False)
     xrig = int(np.round(np.sum(xrig*ww))) # we know that ww sums to 1
     yrig = int(np.round(np.sum(yrig*ww)))
@@ -230,85 +286,184 @@ def rendergrid(r, m, s):
         yy[n+1] = yrig + (n+.5) * (X//5)
     return xx, yy
 
-def _interpolatedshift(z0, r, m, s, x, y, sc):
-    '''_INTERPOLATEDSHIFT - Interpolated shifts at specific points
-    dx, dy = INTERPOLATEDSHIFTS(z0, r, m, s, x, y, sc) calculates the
-    shift for the given tile (r, m, s) at the given point (x, y), specified
-    in global coords, according to the subvolume at z0. SC must be result
-    from SHIFTCOLLECTION.
+def _interpolatedshifts(z0, r, m, s, xx, yy, sc):
+    '''_INTERPOLATEDSHIFTS - Interpolated shifts at specific points
+    dx, dy = _INTERPOLATEDSHIFTS(z0, r, m, s, xx, yy, sc) calculates the
+    shifts for the given tile (r, m, s) at the given points (xx, yy),
+    specified in global coords as vectors, according to the subvolume at
+    z0. SC must be result from SHIFTCOLLECTION.
     We don't simply interpolate. Rather, we assume that 
     dx = a + b (x' - x) + c (y'- y)
-    near the point (x, y) and do a least-squares optimization to find a, b, c.
+    near each point (x, y) and do a least-squares optimization to find a, b, c.
     For that, we set χ² = sum_k w_k (dx(x_k,y_k) - dx_k)²
     where k iterates over all the known shifts in the collection and w_k 
     is a weight set by w_k = 1 / (1 + Δ²_k / Δ²₀) where Δ_k is the distance
     between the k-th measuring point and the point (x, y), and Δ₀ is a 
-    constant.'''
-    # Let's first do dx
+    constant.
+    All points are handled at once, as a stack of 3x3 systems.'''
     Delta0 = 50
-    Deltaxk = sc[0] - x
-    Deltayk = sc[1] - y
+    # Arrays below are indexed by [point, k]
+    Deltaxk = sc[0][None,:] - xx[:,None]
+    Deltayk = sc[1][None,:] - yy[:,None]
     Deltak2 = (Deltaxk)**2 + (Deltayk)**2
     wk = 1 / (1 + Deltak2 / Delta0**2)
     # ∂χ²/χ²a = 2 sum_k w_k (a + b (x_k - x) + c (y_k - y) - dx_k)
     # ∂χ²/χ²b = 2 sum_k w_k (a + b (x_k - x) + c (y_k - y) - dx_k) (x_k - x)
     # ∂χ²/χ²c = 2 sum_k w_k (a + b (x_k - x) + c (y_k - y) - dx_k) (y_k - y)
-    # Solve this as M [a b c]' = B. Drop the factors two
-    M = np.zeros((3,3))
-    M[0,0] = np.sum(wk)
-    M[0,1] = np.sum(wk*Deltaxk)
-    M[0,2] = np.sum(wk*Deltayk)
-    M[1,0] = np.sum(wk*Deltaxk)
-    M[1,1] = np.sum(wk*Deltaxk**2)
-    M[1,2] = np.sum(wk*Deltayk*Deltaxk)
-    M[2,0] = np.sum(wk*Deltayk)
-    M[2,1] = np.sum(wk*Deltaxk*Deltayk)
-    M[2,2] = np.sum(wk*Deltayk**2)
-    B = np.zeros(3)
-    B[0] = np.sum(wk*sc[2])
-    B[1] = np.sum(wk*sc[2]*Deltaxk)
-    B[2] = np.sum(wk*sc[2]*Deltayk)
-    #print(f'Solving R{r} M{m} S{s} x={x} y={y}')
-    #print('M = ', M)
-    #print('B = ', B)
+    # Solve this as M [a b c]' = B for each point. Drop the factors two.
+    # The equation for dy is exactly the same, except that we need dy_k,
+    # so we solve for both at once, as two columns of B.
+    P = len(xx)
+    M = np.zeros((P,3,3))
+    M[:,0,0] = np.sum(wk, 1)
+    M[:,0,1] = np.sum(wk*Deltaxk, 1)
+    M[:,0,2] = np.sum(wk*Deltayk, 1)
+    M[:,1,0] = M[:,0,1]
+    M[:,1,1] = np.sum(wk*Deltaxk**2, 1)
+    M[:,1,2] = np.sum(wk*Deltayk*Deltaxk, 1)
+    M[:,2,0] = M[:,0,2]
+    M[:,2,1] = M[:,1,2]
+    M[:,2,2] = np.sum(wk*Deltayk**2, 1)
+    D = np.stack((sc[2], sc[3]), 1) # Known shifts, indexed by [k, dx/dy]
+    B = np.zeros((P,3,2))
+    B[:,0,:] = wk @ D
+    B[:,1,:] = (wk*Deltaxk) @ D
+    B[:,2,:] = (wk*Deltayk) @ D
     abc = np.linalg.solve(M, B)
-    #print(abc)
-    dx = abc[0]
-    # The equation for dy is exactly the same, except that we need dy_k.
-    B[0] = np.sum(wk*sc[3])
-    B[1] = np.sum(wk*sc[3]*Deltaxk)
-    B[2] = np.sum(wk*sc[3]*Deltayk)
-    abc = np.linalg.solve(M, B)
-    #print(abc)
-    dy = abc[0]
-    return dx, dy
+    return abc[:,0,0], abc[:,0,1]
     
 def interpolatedshifts(r, m, s, xx, yy):
     '''INTERPOLATEDSHIFTS - Interpolated shifts at specific points
     dx, dy = INTERPOLATEDSHIFTS(r, m, s, xx, yy) calculates shifts for 
     the given tile at given points, which are specified in global coords.
-    This uses a weighted average over subvolumes.'''
+    This uses a weighted average over subvolumes.
+    XX and YY may have any shape, and all points are calculated at once,
+    so it is best to pass an entire grid, e.g., from RENDERGRID through
+    np.meshgrid, rather than one quad at a time.'''
     zz0, ww = whence(ri.z(r, s))
     N = len(zz0)
-    scc = []
-    for n in range(N):
-        scc.append(shiftcollection(zz0[n], r, m, s))
+    xx = np.asarray(xx, dtype=float)
+    yy = np.asarray(yy, dtype=float)
     dx = np.zeros(xx.shape)
     dy = np.zeros(xx.shape)
-    for k in range(xx.size):
-        x = xx.flat[k]
-        y = yy.flat[k]
-        ddx = 0
-        ddy = 0
-        for n in range(N):
-            dx1, dy1 = _interpolatedshift(zz0[n], r, m, s, x, y, scc[n])
-            #print(dy1, ww[n])
-            ddx += ww[n] * dx1
-            ddy += ww[n] * dy1
-        dx.flat[k] = ddx
-        dy.flat[k] = ddy
+    for n in range(N):
+        sc = shiftcollection(zz0[n], r, m, s)
+        dx1, dy1 = _interpolatedshifts(zz0[n], r, m, s,
+                                       xx.flatten(), yy.flatten(), sc)
+        dx += ww[n] * dx1.reshape(xx.shape)
+        dy += ww[n] * dy1.reshape(xx.shape)
     return dx, dy
 
+def planfile(r, s):
+    '''PLANFILE - Filename for a saved render plan
+    fn = PLANFILE(r, s) returns the name of the file in which RENDERPLAN
+    stores the plan for slice S of run R.'''
+    return f'{config.root}/renderplan/R{r}/S{s}.npz'
+
+def makerenderplan(r, s):
+    '''MAKERENDERPLAN - Calculate everything needed to render a slice
+    plan = MAKERENDERPLAN(r, s) calculates, for all the montages in slice S
+    of run R at once, the information that rendering needs. The result is
+    a dict with the following entries:
+      touchx, touchy - as from TOUCHLINES(r, s)
+      limits - Mx4 array of RENDERLIMITS for each montage
+      xx, yy - Mx7 arrays of RENDERGRID for each montage
+      x0, y0 - M-vectors of RIGIDTILEPOSITION for each montage
+      dx, dy - Mx7x7 arrays of INTERPOLATEDSHIFTS at the nodes of the
+               grid, where dx[m,iy,ix] is the shift at (xx[m,ix], yy[m,iy]).
+    Shifts are NaN for montages that have no elastic solution.
+    Usually, RENDERPLAN is more useful.'''
+    M = ri.nmontages(r)
+    N = 7
+    touch = touchlines(r, s)
+    plan = { 'touchx': touch[0],
+             'touchy': touch[1],
+             'limits': np.zeros((M,4), dtype=int),
+             'xx': np.zeros((M,N), dtype=int),
+             'yy': np.zeros((M,N), dtype=int),
+             'x0': np.zeros(M),
+             'y0': np.zeros(M),
+             'dx': np.zeros((M,N,N)) + np.nan,
+             'dy': np.zeros((M,N,N)) + np.nan }
+    for m in range(M):
+        plan['limits'][m] = renderlimits(r, m, s, touch)
+        xx, yy = rendergrid(r, m, s, plan['limits'][m])
+        plan['xx'][m] = xx
+        plan['yy'][m] = yy
+        plan['x0'][m], plan['y0'][m] = rigidtileposition(r, m, s)
+        xxx, yyy = np.meshgrid(xx, yy)
+        try:
+            plan['dx'][m], plan['dy'][m] = interpolatedshifts(r, m, s,
+                                                              xxx, yyy)
+        except (np.linalg.LinAlgError, ValueError):
+            print(f'No elastic solution for R{r} M{m} S{s}')
+    return plan
+
+def plankey(r, s):
+    '''PLANKEY - Summary of the solutions that a render plan depends on
+    key = PLANKEY(r, s) returns a string that contains a hash of the rows of
+    the global, montage, rigid, and elastic solutions that
+    MAKERENDERPLAN(r, s) uses, for each of the subvolumes from WHENCE.
+    If any of those rows change, so does the key.'''
+    keys = [','.join(str(v) for v in bbox)]
+    for z0 in whence(ri.z(r, s))[0]:
+        row = db.sel(f'''select
+        (select md5(string_agg(concat_ws(',', x, y), ';'))
+         from {globtbl} where z0={z0}),
+        (select md5(string_agg(concat_ws(',', m, x, y), ';' order by m))
+         from {monttbl} where z0={z0} and r={r}),
+        (select md5(string_agg(concat_ws(',', m, x, y), ';' order by m))
+         from {rigidtbl} where z0={z0} and r={r} and s={s}),
+        (select md5(string_agg(concat_ws(',', m, x, y, dx, dy), ';'
+                               order by m, x, y, dx, dy))
+         from {elastbl} where z0={z0} and r={r} and s={s})''')[0]
+        keys.append(f'{z0}:' + ','.join(str(v) for v in row))
+    return '/'.join(keys)
+
+def renderplan(r, s):
+    '''RENDERPLAN - Everything needed to render a slice
+    plan = RENDERPLAN(r, s) returns the result of MAKERENDERPLAN(r, s),
+    which see. The plan is saved to PLANFILE(r, s) the first time,
+    so that all renderers can share it. Along with the plan, the file
+    stores PLANKEY(r, s), and the plan is recalculated if the key no
+    longer matches, i.e., if the underlying solutions have changed.
+    Plans in which any montage lacks an elastic solution are not saved,
+    so that they are recalculated once the solution is complete.'''
+    fn = planfile(r, s)
+    key = plankey(r, s)
+    if os.path.exists(fn):
+        with np.load(fn) as f:
+            if 'key' in f.files and str(f['key'])==key:
+                return { k: f[k] for k in f.files if k!='key' }
+        print(f'Render plan for R{r} S{s} is out of date')
+    plan = makerenderplan(r, s)
+    if np.any(np.isnan(plan['dx'])):
+        return plan
+    dr = os.path.dirname(fn)
+    os.makedirs(dr, exist_ok=True)
+    # A unique temporary name, so that concurrent renderers cannot clobber
+    # each other's partial files
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=dr)
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, key=key, **plan)
+    os.replace(tmp, fn)
+    return plan
+
+def plannedtile(plan, m):
+    '''PLANNEDTILE - Render grid for one tile from a render plan
+    xx, yy, ximage, yimage = PLANNEDTILE(plan, m) returns the render grid
+    for montage M from a plan obtained from RENDERPLAN, along with the
+    positions of its nodes in the tile, as WARP.GRIDQUAD expects.
+    Returns None if the montage has no elastic solution.'''
+    if np.any(np.isnan(plan['dx'][m])):
+        return None
+    xx = plan['xx'][m]
+    yy = plan['yy'][m]
+    xxx, yyy = np.meshgrid(xx, yy)
+    ximage = xxx - plan['x0'][m] - plan['dx'][m]
+    yimage = yyy - plan['y0'][m] - plan['dy'][m]
+    return xx, yy, ximage, yimage
+
 if __name__=='__main__':
     import pyqplot as qp
     r = 3
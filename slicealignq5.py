@@ -19,6 +19,7 @@ import sys
 import traceback
 
 import swiftir
+import swimbatch
 import pyqplot as qp
 import numpy as np
 
@@ -59,16 +60,16 @@ def maketable():
     syc float,
     snrc float 
     )''')
+    # Number of swim runs actually done; the third may be skipped
+    # (see swimbatch.converged). Null for rows from before that existed.
+    db.exe('''alter table slicealignq5 add column if not exists npass integer''')
 
 ri = db.runinfo()
 
-def alignsubtiles(r, m1, m2, s, ii, sidebyside):
-    cnt = db.sel(f'''select count(1) from slicealignq5 
-    where r={r} and m1={m1} and m2={m2} and s={s}
-    and ii={ii}''')
-    if cnt[0][0]>0:
-        return
-    print(f'Working on r{r} m{m1}:{m2} s{s} {ii}')
+def edgeimages(r, m1, m2, s, ii, sidebyside):
+    # Returns the overlapping parts of the edge subtiles of M1 and M2
+    # at position II along the edge, and their centers in montage
+    # coordinates.
     if sidebyside:
         ix1 = 4
         iy1 = ii
@@ -119,56 +120,81 @@ def alignsubtiles(r, m1, m2, s, ii, sidebyside):
         y2 = (y2t+y2b)//2
         #y1 = Y//2 - dy0/2 + Y*4
         #y2 = Y//2 + dy0/2
-    Y,X = img1.shape        
-    apo1 = swiftir.apodize(img1)
-    apo2 = swiftir.apodize(img2)
-    (dx, dy, sx, sy, snr) = swiftir.swim(apo1, apo2)
-
-    win1 = swiftir.extractStraightWindow(img1, (X/2-dx/2,Y/2-dy/2),(X//2,Y//2))
-    win2 = swiftir.extractStraightWindow(img2, (X/2+dx/2,Y/2+dy/2),(X//2,Y//2))
-    apo1b = swiftir.apodize(win1)
-    apo2b = swiftir.apodize(win2)
-    (dxb, dyb, sxb, syb, snrb) = swiftir.swim(apo1b, apo2b)
-
-    dx1 = dx+dxb
-    dy1 = dy+dyb
-    win1 = swiftir.extractStraightWindow(img1,(X/2-dx1/2,Y/2-dy1/2),(X//2,Y//2))
-    win2 = swiftir.extractStraightWindow(img2,(X/2+dx1/2,Y/2+dy1/2),(X//2,Y//2))
-    apo1b = swiftir.apodize(win1)
-    apo2b = swiftir.apodize(win2)
-    (dxc, dyc, sxc, syc, snrc) = swiftir.swim(apo1b, apo2b)
-
-    #print(f'{r} {m1}:{m2} {s} {ix1},{iy1}:{ix2}:{iy2} {dx0}+{dx}+{dxb}+{dxc} {dy0}+{dy}+{dyb}+{dyc}')
-    
-    db.exe(f'''insert into slicealignq5 
-    (r,m1,m2,s,ii, x1,y1, x2,y2,
-    dx,dy,sx,sy,snr, dxb,dyb,sxb,syb,snrb, dxc,dyc,sxc,syc,snrc)
-    values
-    ({r},{m1},{m2},{s},{ii}, {x1},{y1}, {x2},{y2},
-    {dx},{dy},{sx},{sy},{snr}, 
-    {dxb},{dyb},{sxb},{syb},{snrb},
-    {dxc},{dyc},{sxc},{syc},{snrc})''')
+    return img1, img2, x1, y1, x2, y2
 
-def alignsidebyside(r, m1, m2, s):
-    for iy in range(5):
+def alignedge(r, m1, m2, s, sidebyside):
+    # All positions along the edge are aligned together, one SWIM batch
+    # per pass
+    iii = [ii for ii in range(5) if done.count(r, m1, m2, s, ii)==0]
+    if len(iii)==0:
+        return
+    print(f'Working on r{r} m{m1}:{m2} s{s} {iii}')
+    # A position that cannot be prepared is dropped, so that it does not
+    # take the rest of the edge down with it
+    edges = []
+    good = []
+    for ii in iii:
         try:
-            alignsubtiles(r, m1, m2, s, iy, True)
+            edge = edgeimages(r, m1, m2, s, ii, sidebyside)
+            if len(edges) and (edge[0].shape != edges[0][0].shape
+                               or edge[1].shape != edges[0][1].shape):
+                raise ValueError(f'Unexpected image size {edge[0].shape}')
         except Exception as e:
             print(e)
-            print(f'Failed to align r{r} m{m1}:{m2} s{s} iy{iy}')
+            print(f'Failed to align r{r} m{m1}:{m2} s{s} {ii}')
+            continue
+        edges.append(edge)
+        good.append(ii)
+    iii = good
+    if len(iii)==0:
+        return
+    imgs1 = [e[0] for e in edges]
+    imgs2 = [e[1] for e in edges]
+    Y,X = imgs1[0].shape
+    SIZ = (X//2, Y//2)
+
+    res = swimbatch.swim(np.stack(imgs1), np.stack(imgs2))
+    dx = res[:,0]
+    dy = res[:,1]
+
+    # The second pass is always run, because it uses smaller windows
+    # than the first, so its SNR is on a different scale.
+    npass = 2 * np.ones(len(iii), dtype=int)
+    win1 = swimbatch.extract(imgs1, np.stack((X/2-dx/2, Y/2-dy/2), 1), SIZ)
+    win2 = swimbatch.extract(imgs2, np.stack((X/2+dx/2, Y/2+dy/2), 1), SIZ)
+    resb = swimbatch.swim(win1, win2)
+
+    run = ~swimbatch.converged(resb, SIZ)
+    resc = swimbatch.skipped(resb)
+    if np.any(run):
+        dx1 = dx + resb[:,0]
+        dy1 = dy + resb[:,1]
+        win1 = swimbatch.extract(imgs1, np.stack((X/2-dx1/2, Y/2-dy1/2), 1), SIZ)
+        win2 = swimbatch.extract(imgs2, np.stack((X/2+dx1/2, Y/2+dy1/2), 1), SIZ)
+        resc[run] = swimbatch.swim(win1[run], win2[run])
+        npass[run] = 3
+
+    for k in range(len(iii)):
+        x1, y1, x2, y2 = edges[k][2:]
+        sink.add(r,m1,m2,s,iii[k], x1,y1, x2,y2,
+                 *res[k], *resb[k], *resc[k], npass[k])
+
+def alignsidebyside(r, m1, m2, s):
+    try:
+        alignedge(r, m1, m2, s, True)
+    except Exception as e:
+        print(e)
+        print(f'Failed to align r{r} m{m1}:{m2} s{s}')
 
 def alignabove(r, m1, m2, s):
-    for ix in range(5):
-        try:
-            alignsubtiles(r, m1, m2, s, ix, False)
-        except Exception as e:
-            print(e)
-            print(f'Failed to align r{r} m{m1}:{m2} s{s} ix{ix}')
+    try:
+        alignedge(r, m1, m2, s, False)
+    except Exception as e:
+        print(e)
+        print(f'Failed to align r{r} m{m1}:{m2} s{s}')
         
 def aligntiles(r, m1, m2, s):
-    cnt = db.sel(f'''select count(1) from slicealignq5 
-    where r={r} and m1={m1} and m2={m2} and s={s}''')
-    if cnt[0][0]==5:
+    if done.count(r, m1, m2, s)==5:
         return
     C = ri.ncolumns(r)
     if C==2 and (m1%2==0 and m2==m1+1):
@@ -186,22 +212,27 @@ def alignmanytiles(r, m1, m2):
 fac = factory.Factory(nthreads)
         
 def queuealignmanytiles(r, m1, m2):
-    cnt = db.sel(f'''select count(1) from slicealignq5 
-    where r={r} and m1={m1} and m2={m2}''')
     S = ri.nslices(r)
-    if cnt[0][0]==5*S:
+    if done.count(r, m1, m2)==5*S:
         return
     print(f'Requesting r{r} m{m1}:{m2}')
     fac.request(alignmanytiles, r, m1, m2)
 
 maketable()
+done = db.done('slicealignq5', ['r', 'm1', 'm2', 's', 'ii'])
+sink = db.sink('slicealignq5',
+               ['r', 'm1', 'm2', 's', 'ii', 'x1', 'y1', 'x2', 'y2',
+                'dx', 'dy', 'sx', 'sy', 'snr',
+                'dxb', 'dyb', 'sxb', 'syb', 'snrb',
+                'dxc', 'dyc', 'sxc', 'syc', 'snrc', 'npass'],
+               done=done)
     
 for r0 in range(ri.nruns()):
     r  = r0 + 1
     print(f'Considering run {r}')
     ROWS = ri.nrows(r)
     COLS = ri.ncolumns(r)
-    cnt = db.sel(f'''select count(1) from slicealignq5 where r={r}''')[0][0]
+    cnt = done.count(r)
     if COLS==1:
         if cnt<(ROWS-1)*5*ri.nslices(r):
             # Above
@@ -222,4 +253,5 @@ for r0 in range(ri.nruns()):
         raise Exception(f'Not handling {COLS} columns')
 
 print(f'Waiting for factory to end')
-fac.shutdown()    
+fac.shutdown()
+sink.close()
@@ -94,10 +94,8 @@ def optisub(z0):
     mp5.assignK(mpp)
     ap = mp5.allpoints(mpp)
     idx = mp5.elasticindex(mpp)
-    Ax, bx = mp5.elasticmatrix(mpp, idx, ap, 0)
-    Ay, by = mp5.elasticmatrix(mpp, idx, ap, 1)
-    dx = scipy.sparse.linalg.spsolve(Ax.tocsr(), bx)
-    dy = scipy.sparse.linalg.spsolve(Ay.tocsr(), by)
+    A, b = mp5.elasticmatrix(mpp, idx, ap)
+    dx, dy = mp5.solve(A, b)
     dx = mp5.elasticdeindex(idx, dx)
     dy = mp5.elasticdeindex(idx, dy)
     return ap, dx, dy
@@ -106,40 +104,39 @@ def dooptisub(z0):
     print(f'Optimizing Z{z0}+{nz}')
     ap, dx, dy = optisub(z0)
     print(f'Inserting Z{z0}+{nz} into db')
-    with db.db:
-        with db.db.cursor() as c:
-            c.execute(f'delete from {outtbl} where z0={z0}') # clean up
-            for rms,xy in ap.items():
-                K = len(xy[0])
-                r,m,s = rms
-                if rms in dx and rms in dy:
-                    dx1 = dx[rms]
-                    dy1 = dy[rms]
-                else:
-                    dx1 = np.zeros(K)
-                    dy1 = np.zeros(K)
-                    print(f'Warning: no data in {z0} for {rms}')
-                if K>0:
-                    vallist = []
-                    for k in range(K):
-                        vallist.append(f'''( {z0}, {r}, {m}, {s},
-                            {xy[0][k]}, {xy[1][k]}, {dx1[k]}, {dy1[k]} )''')
-                    valall = ','.join(vallist)
-                    c.execute(f'''insert into {outtbl}
-                        ( z0, r, m, s, x, y, dx, dy )
-                        values {valall}''')
+    with db.transaction() as c:
+        c.execute(f'delete from {outtbl} where z0={z0}') # clean up
+        for rms,xy in ap.items():
+            K = len(xy[0])
+            r,m,s = rms
+            if rms in dx and rms in dy:
+                dx1 = dx[rms]
+                dy1 = dy[rms]
+            else:
+                dx1 = np.zeros(K)
+                dy1 = np.zeros(K)
+                print(f'Warning: no data in {z0} for {rms}')
+            if K>0:
+                vallist = []
+                for k in range(K):
+                    vallist.append(f'''( {z0}, {r}, {m}, {s},
+                        {xy[0][k]}, {xy[1][k]}, {dx1[k]}, {dy1[k]} )''')
+                valall = ','.join(vallist)
+                c.execute(f'''insert into {outtbl}
+                    ( z0, r, m, s, x, y, dx, dy )
+                    values {valall}''')
 
 def perhapsoptisub(z0):
-    cnt = db.sel(f'select count(*) from {rigidtbl} where z0={z0}')
-    if cnt[0][0]==0:
+    if rigiddone.count(z0)==0:
         print(f'Skipping {z0}+{nz} - not yet done at rigid level')
         return
-    cnt = db.sel(f'select count(*) from {outtbl} where z0={z0}')
-    if cnt[0][0]==0:
+    if done.count(z0)==0:
         dooptisub(z0)
         
 createtable()
 dropindex()
+rigiddone = db.done(rigidtbl, ['z0'])
+done = db.done(outtbl, ['z0'])
 
 R = ri.nruns()
 Z = ri.z0(R) + ri.nslices(R)
@@ -151,7 +148,7 @@ if len(args)>0:
         z0 = int(a)
         dooptisub(z0)
 else:
-    fac = factory.Factory(nthreads)
+    fac = factory.Factory(nthreads, processes=True)
     for z0 in range(4, Z-nz//2, nz//2):
         fac.request(perhapsoptisub, z0)
     fac.shutdown()
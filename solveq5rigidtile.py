@@ -63,33 +63,31 @@ def optisub(z0):
     mpp = subvol_rigidtile(sv)
     subtract_mont(z0, mpp)
     idx = mp5.index(mpp)
-    Ax, bx = mp5.matrix(mpp, idx, 0)
-    Ay, by = mp5.matrix(mpp, idx, 1)
-    xm = np.linalg.solve(Ax, bx)
-    ym = np.linalg.solve(Ay, by)
+    A, b = mp5.matrix(mpp, idx)
+    xm, ym = mp5.solve(A, b)
     xm = mp5.deindex(idx, xm)
     ym = mp5.deindex(idx, ym)
     return xm, ym
 
 def perhapsoptisub(z0):
-    cnt = db.sel(f'select count(*) from {intbl} where z0={z0}')
-    if cnt[0][0]==0:
+    if montdone.count(z0)==0:
         print(f'Skipping {z0}+{nz} - not yet done at mont level')
         return
-    cnt = db.sel(f'select count(*) from {outtbl} where z0={z0}')
-    if cnt[0][0]>0:
+    if done.count(z0)>0:
         return
     print(f'Working on {z0}+{nz}')
     xm, ym = optisub(z0)
-    with db.db:
-        with db.db.cursor() as c:
-            for k in xm:
-                c.execute(f'''insert into {outtbl}
-                ( z0, r, m, s, x, y )
-                values
-                ( {z0}, {k[0]}, {k[1]}, {k[2]}, {xm[k]}, {ym[k]} )''')
+    with db.transaction() as c:
+        for k in xm:
+            c.execute(f'''insert into {outtbl}
+            ( z0, r, m, s, x, y )
+            values
+            ( {z0}, {k[0]}, {k[1]}, {k[2]}, {xm[k]}, {ym[k]} )''')
+    done.add(z0, n=len(xm))
         
 createtable()
+montdone = db.done(intbl, ['z0'])
+done = db.done(outtbl, ['z0'])
 
 fac = factory.Factory(nthreads)
 R = ri.nruns()
@@ -66,32 +66,30 @@ def subvol_slice(r, s):
 def optislice(r, s):
     mpp = subvol_slice(r, s)
     idx = mp5.index(mpp)
-    Ax, bx = mp5.matrix(mpp, idx, 0)
-    Ay, by = mp5.matrix(mpp, idx, 1)
-    xm = np.linalg.solve(Ax, bx)
-    ym = np.linalg.solve(Ay, by)
+    A, b = mp5.matrix(mpp, idx)
+    xm, ym = mp5.solve(A, b)
     xm = mp5.deindex(idx, xm)
     ym = mp5.deindex(idx, ym)
     return xm, ym
 
 def perhapsoptislice(r, s, force=False):
     if not force:
-        cnt = db.sel(f'select count(*) from {outtbl} where r={r} and s={s}')
-        if cnt[0][0]>0:
+        if done.count(r, s)>0:
             return
     print(f'Working on R{r} S{s}')
     xm, ym = optislice(r, s)
-    with db.db:
-        with db.db.cursor() as c:
-            c.execute(f'delete from {outtbl} where r={r} and s={s}')
-            for k in xm:
-                print(r, k, s, xm[k], ym[k])
-                c.execute(f'''insert into {outtbl}
-                ( r, m, s, x, y )
-                values
-                ( {r}, {k[1]}, {s}, {xm[k]}, {ym[k]} )''')
+    with db.transaction() as c:
+        c.execute(f'delete from {outtbl} where r={r} and s={s}')
+        for k in xm:
+            print(r, k, s, xm[k], ym[k])
+            c.execute(f'''insert into {outtbl}
+            ( r, m, s, x, y )
+            values
+            ( {r}, {k[1]}, {s}, {xm[k]}, {ym[k]} )''')
+    done.add(r, s, n=len(xm))
         
 createtable()
+done = db.done(outtbl, ['r', 's'])
 
 fac = factory.Factory(nthreads)
 
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+'''SWIMBATCH - SWIM alignment of many window pairs at once
+
+This module does the same job as SWIFTIR.APODIZE followed by SWIFTIR.SWIM,
+but on stacks of same-sized window pairs, so that callers can extract,
+align, and decide on refinement for all the windows along an edge in one
+go. Stacks are 3-D arrays of shape NxYxX. The FFTs, whitening, and peak
+finding are done on whole stacks at once, and spectra of windows that
+are used in several pairs can be calculated once and reused.
+The algorithm is a port of SWIFTIR's, and results are the same
+(dx, dy, sx, sy, snr) that SWIFTIR.SWIM returns, where (dx, dy) is the
+shift such that pixel (x, y) of the first window corresponds to pixel
+(x+dx, y+dy) of the second. That matters, because results end up in the
+same tables as those of older runs, and are thresholded together by
+MATCHPOINTSQ5. Run this file as a script to check that against
+SWIFTIR.SWIM.'''
+
+import numpy as np
+import swiftir
+import scipy.fft
+import functools
+
+WHITENING = -.65 # As the default in SWIFTIR.SWIM
+PEAKRADIUS = 2 # Half-size of the neighborhood used for subpixel peak position
+
+# Refinement passes are skipped once the previous pass moved the windows
+# by less than TOLERANCE pixels with an SNR of at least MINSNR.
+# SNR grows about linearly with the side of the window, so MINSNR is
+# given for 512x512 windows and scaled by sqrt(w*h)/512 for others.
+# Set MINSNR to None to always run all passes.
+TOLERANCE = .1
+MINSNR = 50
+
+@functools.lru_cache(maxsize=16)
+def window(Y, X):
+    '''WINDOW - Apodization window
+    win = WINDOW(Y, X) returns the YxX window by which SWIFTIR.APODIZE
+    multiplies (mean-subtracted) images of that size. It is found by
+    applying SWIFTIR.APODIZE to a zero-mean test pattern that has no
+    zeros, so it is exactly SWIFTIR's. The result is cached and
+    read-only.'''
+    tst = np.indices((Y, X)).sum(0) % 2 * 2 - 1.
+    tst -= np.mean(tst)
+    win = swiftir.apodize(tst) / tst
+    win.setflags(write=False)
+    return win
+
+def extract(imgs, cc, siz):
+    '''EXTRACT - Extract a stack of windows
+    wins = EXTRACT(imgs, cc, siz) extracts a window of size SIZ = (w, h)
+    from each of the images in the list IMGS, centered at the corresponding
+    point (x, y) in CC, using SWIFTIR.EXTRACTSTRAIGHTWINDOW, and returns
+    them as an NxHxW stack.'''
+    return np.stack([swiftir.extractStraightWindow(img, c, siz)
+                     for img, c in zip(imgs, cc)])
+
+def apodize(wins):
+    '''APODIZE - Apodize a stack of windows
+    apos = APODIZE(wins) subtracts its mean from each window in the NxYxX
+    stack WINS and multiplies the result by WINDOW(Y, X), like
+    SWIFTIR.APODIZE does for a single window.'''
+    wins = np.asarray(wins, dtype=float)
+    N, Y, X = wins.shape
+    avg = np.mean(wins, axis=(1,2), keepdims=True)
+    return (wins - avg) * window(Y, X)
+
+def spectra(apos):
+    '''SPECTRA - Fourier transform a stack of apodized windows
+    ff = SPECTRA(apos) returns the 2-D real FFTs of each of the windows
+    in the stack APOS. The results can be passed to SWIMSPECTRA, and
+    may be reused for several pairs.'''
+    return scipy.fft.rfft2(apos, axes=(1,2))
+
+def findpeaks(cc):
+    '''FINDPEAKS - Locate the peaks in a stack of correlation images
+    res = FINDPEAKS(cc) where CC is an NxYxX stack of centered (i.e.,
+    fftshifted) cross-correlation images, returns an Nx5 array with a
+    row (dx, dy, sx, sy, snr) for each, as SWIFTIR's peak finder does:
+    The peak position is refined by the center of mass of the
+    (2*PEAKRADIUS+1)-pixel square around the maximum, after subtracting
+    the mean, and its width (sx, sy) is the standard deviation of that
+    same mass. SNR is the height of the peak above the mean in units of
+    the standard deviation of the image.'''
+    N, Y, X = cc.shape
+    nn = np.arange(N)
+    k = np.argmax(cc.reshape(N, -1), 1)
+    py = k // X
+    px = k % X
+    peak = cc[nn, py, px]
+    avg = np.mean(cc, axis=(1,2))
+    std = np.std(cc, axis=(1,2))
+
+    dd = np.arange(-PEAKRADIUS, PEAKRADIUS+1)
+    nb = cc[nn[:,None,None],
+            ((py[:,None] + dd) % Y)[:,:,None],
+            ((px[:,None] + dd) % X)[:,None,:]]
+    nb = np.maximum(nb - avg[:,None,None], 0)
+    tot = np.sum(nb, axis=(1,2))
+    mx = np.sum(nb * dd[None,None,:], axis=(1,2)) / tot
+    my = np.sum(nb * dd[None,:,None], axis=(1,2)) / tot
+    sx = np.sqrt(np.sum(nb * dd[None,None,:]**2, axis=(1,2)) / tot - mx**2)
+    sy = np.sqrt(np.sum(nb * dd[None,:,None]**2, axis=(1,2)) / tot - my**2)
+    dx = px + mx - X//2
+    dy = py + my - Y//2
+    snr = (peak - avg) / std
+    return np.stack((dx, dy, sx, sy, snr), 1)
+
+def swimspectra(ff1, ff2, shape, wht=WHITENING):
+    '''SWIMSPECTRA - SWIM alignment of pre-transformed windows
+    res = SWIMSPECTRA(ff1, ff2, shape) where FF1 and FF2 are stacks of
+    spectra from SPECTRA, calculates the whitened cross-correlation of
+    each pair and locates its peak with FINDPEAKS. SHAPE is the (Y, X)
+    shape of the original windows. FF1 may also be a single spectrum
+    (a stack of one), which is then used for every pair. The result
+    is an Nx5 array with a row (dx, dy, sx, sy, snr) for each pair.
+    Optional argument WHT is the whitening exponent.'''
+    prd = np.conj(ff1) * ff2
+    if wht:
+        prd *= np.abs(prd) ** wht
+    cc = scipy.fft.irfft2(prd, s=shape, axes=(1,2))
+    return findpeaks(scipy.fft.fftshift(cc, axes=(1,2)))
+
+def swim(wins1, wins2, wht=WHITENING):
+    '''SWIM - SWIM alignment of a stack of window pairs
+    res = SWIM(wins1, wins2) apodizes each of the windows in the NxYxX
+    stacks WINS1 and WINS2 and calculates their alignment. The result is
+    an Nx5 array with a row (dx, dy, sx, sy, snr) for each pair.'''
+    apo1 = apodize(wins1)
+    apo2 = apodize(wins2)
+    return swimspectra(spectra(apo1), spectra(apo2), apo1.shape[1:], wht)
+
+def snrthreshold(siz, minsnr=None):
+    '''SNRTHRESHOLD - SNR threshold for a given window size
+    thr = SNRTHRESHOLD(siz) returns MINSNR scaled from 512x512 windows
+    to windows of size SIZ = (w, h). Optional argument MINSNR overrides
+    the module default, and is also given for 512x512 windows.'''
+    if minsnr is None:
+        minsnr = MINSNR
+    if minsnr is None:
+        return None
+    return minsnr * np.sqrt(siz[0] * siz[1]) / 512
+
+def converged(res, siz, tol=None, minsnr=None):
+    '''CONVERGED - Test whether further SWIM passes are needed
+    ok = CONVERGED(res, siz) where RES is an Nx5 array as returned by
+    SWIM for windows of size SIZ = (w, h) returns a boolean vector that
+    is True for those pairs where the shift is less than TOLERANCE and
+    the SNR is at least SNRTHRESHOLD(siz), so that further refinement
+    passes would not change anything.
+    Optional arguments TOL and MINSNR override the module defaults.'''
+    if tol is None:
+        tol = TOLERANCE
+    thr = snrthreshold(siz, minsnr)
+    res = np.asarray(res)
+    if thr is None:
+        return np.zeros(res.shape[0], dtype=bool)
+    return ((res[:,0]**2 + res[:,1]**2 < tol**2) & (res[:,4] >= thr))
+
+def skipped(res):
+    '''SKIPPED - Stand-in results for a skipped SWIM pass
+    res1 = SKIPPED(res) returns an Nx5 array like RES with zero shift
+    and NaN for peak width and SNR, for storing in place of a pass that
+    was not run. That way, sums of shifts over passes remain valid,
+    while the SNR of a pass that was not run is never mistaken for a
+    real one. Readers should take the SNR from the last pass actually
+    run (see NPASS in the tables and MATCHPOINTSQ5).'''
+    res1 = np.zeros(np.shape(res))
+    res1[:,2:] = np.nan
+    return res1
+
+if __name__=='__main__':
+    # Check that results are exactly those of SWIFTIR.SWIM on some sample
+    # windows with known shifts
+    rng = np.random.default_rng(1)
+    img = rng.normal(0, 1, (1200, 1200))
+    img = np.cumsum(np.cumsum(img, 0), 1) # Smooth, image-like texture
+    for siz in [(512, 512), (342, 171), (256, 256)]:
+        cc = [(600, 600), (500, 650), (700, 550)]
+        shf = [(0, 0), (3.5, -2), (-7, 5.25)]
+        wins1 = extract([img]*3, cc, siz)
+        wins2 = extract([img]*3, [(x+dx, y+dy) for (x,y), (dx,dy)
+                                  in zip(cc, shf)], siz)
+        apos1 = apodize(wins1)
+        res = swim(wins1, wins2)
+        # Reusing the spectrum of one window against several
+        ff1 = spectra(apos1[:1])
+        res1 = swimspectra(ff1, spectra(apodize(wins2)), apos1.shape[1:])
+        for n in range(len(cc)):
+            apo1 = swiftir.apodize(wins1[n])
+            assert np.allclose(apos1[n], apo1), (siz, n)
+            ref = swiftir.swim(apo1, swiftir.apodize(wins2[n]))
+            assert np.allclose(res[n], ref, equal_nan=True), (siz, n)
+            ref = swiftir.swim(swiftir.apodize(wins1[0]),
+                               swiftir.apodize(wins2[n]))
+            assert np.allclose(res1[n], ref, equal_nan=True), (siz, n)
+        print(siz, res)
+    print('SWIMBATCH agrees with SWIFTIR.SWIM')
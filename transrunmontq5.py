@@ -9,6 +9,7 @@ import rawimage
 import pyqplot as qp
 import numpy as np
 import swiftir
+import swimbatch
 import factory
 
 db = aligndb.DB()
@@ -25,6 +26,17 @@ IX = IY = 5
 PICTURES = False
 nthreads = 12
 
+# In pyramid mode, the offset between runs is first refined per montage
+# at Q25, so that each subtile needs only a single correlation at Q5.
+# Montages where the Q25 match has SNR below COARSESNR are done the old
+# way. The Q5 correlation uses the same 512x512 windows as the old way,
+# so that snrb, which MATCHPOINTSQ5 thresholds on, has the same scale
+# for all rows.
+PYRAMID = True
+COARSESNR = 10
+COARSESIZ = (342, 342)
+REFINESIZ = (512, 512)
+
 def maketable():
     db.exe(f'''create table if not exists {outtbl} (
     r integer,
@@ -50,9 +62,64 @@ def maketable():
     sxb float,
     syb float,
     snrb float )''')
+    # Number of swim runs actually done; later ones may be skipped
+    # (see swimbatch.converged). Null for rows from before that existed.
+    db.exe(f'''alter table {outtbl} add column if not exists npass integer''')
+
+def globalshift(r, r1):
+    # Shift between runs R and R1 according to INTBL, in OUTQ pixels
+    if r1<r:
+        dx,dy = db.sel(f'select dx+dxb, dy+dyb from {intbl} where r2={r}')[0]
+    else:
+        dx,dy = db.sel(f'select -dx-dxb, -dy-dyb from {intbl} where r2={r1}')[0]
+    dx *= inq/outq
+    dy *= inq/outq
+    return dx, dy
+
+def montageoffset(r, m, s, r1, s1):
+    # Matches the center of montage M to run R1 at Q25, starting from
+    # the GLOBALSHIFT prediction. Returns (dx, dy, sx, sy, snr) in OUTQ
+    # pixels, where (dx, dy) is the correction to the predicted position,
+    # or None if the match is not good enough to rely on.
+    img = rawimage.q25img(r, m, s)
+    if img is None:
+        return None
+    x0,y0 = db.sel(f'''select x,y from {roughtbl}
+    where r={r} and m={m} and s={s}''')[0]
+    mm1,xx1,yy1 = db.vsel(f'''select m,x,y from {roughtbl} 
+    where r={r1} and s={s1}
+    order by m''')
+    dx, dy = globalshift(r, r1)
+    xc = x0 + X*2.5
+    yc = y0 + Y*2.5
+    m1 = mm1[np.argmin((xc-dx - (xx1 + X*2.5))**2
+                       + (yc-dy - (yy1 + Y*2.5))**2)]
+    img1 = rawimage.q25img(r1, m1, s1)
+    if img1 is None:
+        return None
+    f = inq/outq
+    x1c = (xc-dx - xx1[m1]) / f
+    y1c = (yc-dy - yy1[m1]) / f
+    # Keep the window inside the other tile and move the window in this
+    # tile along with it
+    Y1,X1 = img1.shape
+    W,H = COARSESIZ
+    x1w = np.clip(x1c, W/2, X1-W/2)
+    y1w = np.clip(y1c, H/2, Y1-H/2)
+    Y0,X0 = img.shape
+    win1 = swiftir.extractStraightWindow(img, (X0/2 + x1w - x1c,
+                                               Y0/2 + y1w - y1c), COARSESIZ)
+    win2 = swiftir.extractStraightWindow(img1, (x1w, y1w), COARSESIZ)
+    res = swimbatch.swim(win1[None], win2[None])[0]
+    print(f'Montage offset r{r} m{m} to r{r1}: {res}')
+    if res[4] < COARSESNR:
+        return None
+    return res[0]*f, res[1]*f, res[2]*f, res[3]*f, res[4]
 
-def transrunmont(r, m, s, ix, iy, r1, s1):
+def transrunmont(r, m, s, ix, iy, r1, s1, coarse=None):
     # s must be zero or last, s1 must be last or zero r1 must be r +- 1
+    # If COARSE is given, it is the result of MONTAGEOFFSET, and only
+    # a single refinement pass is done.
     print(f'Working on r{r} m{m} s{s} ix{ix},iy{iy} to r{r1} s{s1}')
     img = rawimage.partialq5img(r, m, s, ix, iy)
     x0,y0 = db.sel(f'''select x,y from {roughtbl}
@@ -60,12 +127,7 @@ def transrunmont(r, m, s, ix, iy, r1, s1):
     mm1,xx1,yy1 = db.vsel(f'''select m,x,y from {roughtbl} 
     where r={r1} and s={s1}
     order by m''')
-    if r1<r:
-        dx,dy = db.sel(f'select dx+dxb, dy+dyb from {intbl} where r2={r}')[0]
-    else:
-        dx,dy = db.sel(f'select -dx-dxb, -dy-dyb from {intbl} where r2={r1}')[0]
-    dx *= inq/outq
-    dy *= inq/outq
+    dx, dy = globalshift(r, r1)
 
     # Center of tile in run space
     xc = x0 + X*(ix+.5)
@@ -75,13 +137,18 @@ def transrunmont(r, m, s, ix, iy, r1, s1):
     xx1c = xx1 + (X*2.5)
     yy1c = yy1 + (X*2.5)
 
-    # Presumed best montage to match
-    m1 = mm1[np.argmin((xc+dx - xx1c)**2 + (yc-dy - yy1c)**2)]
+    if coarse is None:
+        cdx = cdy = 0
+        # Presumed best montage to match
+        m1 = mm1[np.argmin((xc+dx - xx1c)**2 + (yc-dy - yy1c)**2)]
+    else:
+        cdx, cdy = coarse[:2]
+        m1 = mm1[np.argmin((xc-dx+cdx - xx1c)**2 + (yc-dy+cdy - yy1c)**2)]
     # Position in that montage that should match
     x1c = xc-dx - xx1[m1]
     y1c = yc-dy - yy1[m1]
-    ix1 = int(x1c/X+.5)
-    iy1 = int(y1c/Y+.5)
+    ix1 = int((x1c+cdx)/X+.5)
+    iy1 = int((y1c+cdy)/Y+.5)
     if ix1<=0:
         ix1=1
     elif ix1>=5:
@@ -96,18 +163,13 @@ def transrunmont(r, m, s, ix, iy, r1, s1):
     x1croi = x1c - (ix1-1)*X
     y1croi = y1c - (iy1-1)*Y
 
-    if x1croi<0 or x1croi>2*X or y1croi<0 or y1croi>2*Y:
+    if (x1croi+cdx<0 or x1croi+cdx>2*X
+        or y1croi+cdy<0 or y1croi+cdy>2*Y):
         # Have nothing to connect to
-        db.exe(f'''insert into {outtbl}
-            (r, m, s, ix, iy,
-            r2, m2, s2, x, y,
-            dx, dy, sx, sy, snr,
-            dxb, dyb, sxb, syb, snrb)
-            values
-            ({r}, {m}, {s}, {ix}, {iy},
-            {r1}, {m1}, {s1}, {x1c}, {y1c},
-            0,0,0,0,0,
-            0,0,0,0,0)''')
+        sink.add(r, m, s, ix, iy,
+                 r1, m1, s1, x1c, y1c,
+                 0,0,0,0,0,
+                 0,0,0,0,0, 0)
         return
 
     if PICTURES:
@@ -122,39 +184,65 @@ def transrunmont(r, m, s, ix, iy, r1, s1):
         qp.marker('+')
         qp.mark(x1croi, -y1croi)
 
+    if coarse is not None:
+        # Single refinement pass around the montage-level match
+        (dx, dy, sx, sy, snr) = coarse
+        win1 = swiftir.extractStraightWindow(img, (X/2,Y/2), REFINESIZ)
+        win2 = swiftir.extractStraightWindow(img1, (x1croi+dx, y1croi+dy),
+                                             REFINESIZ)
+        res = swimbatch.swim(win1[None], win2[None])
+        # The Q25 match counts as the first pass
+        sink.add(r, m, s, ix, iy,
+                 r1, m1, s1, x1c, y1c,
+                 dx, dy, sx, sy, snr,
+                 *res[0], 2)
+        return
+
     SIZ = (512, 512)
+    SHP = (SIZ[1], SIZ[0]) # Shape of the windows
     win1 = swiftir.extractStraightWindow(img, (X/2,Y/2), SIZ)
-    apo1 = swiftir.apodize(win1)
+    apo1 = swimbatch.apodize(win1[None])
+    ff1 = swimbatch.spectra(apo1) # Used for every pass
     win2 = swiftir.extractStraightWindow(img1, (x1croi,y1croi), SIZ)
-    apo2 = swiftir.apodize(win2)
+    apo2 = swimbatch.apodize(win2[None])
 
     if PICTURES:
         qp.figure('/tmp/s1b', 4, 4)
-        qp.imsc(apo1)
+        qp.imsc(apo1[0])
         
         qp.figure('/tmp/s2b', 4, 4)
-        qp.imsc(apo2)
+        qp.imsc(apo2[0])
 
-    (dx, dy, sx, sy, snr) = swiftir.swim(apo1, apo2)
+    res = swimbatch.swimspectra(ff1, swimbatch.spectra(apo2), SHP)
+    (dx, dy, sx, sy, snr) = res[0]
+    if swimbatch.converged(res, SIZ)[0]:
+        sink.add(r, m, s, ix, iy,
+                 r1, m1, s1, x1c, y1c,
+                 *res[0], *swimbatch.skipped(res)[0], 1)
+        return
     
     win2 = swiftir.extractStraightWindow(img1, (x1croi+dx, y1croi+dy), SIZ)
-    apo2 = swiftir.apodize(win2)
+    apo2 = swimbatch.apodize(win2[None])
 
     if PICTURES:
         qp.figure('/tmp/s1a', 4, 4)
-        qp.imsc(apo1)
+        qp.imsc(apo1[0])
         
         qp.figure('/tmp/s2a', 4, 4)
-        qp.imsc(apo2)
+        qp.imsc(apo2[0])
     
-    (dxb, dyb, sxb, syb, snrb) = swiftir.swim(apo1, apo2)
+    res = swimbatch.swimspectra(ff1, swimbatch.spectra(apo2), SHP)
+    (dxb, dyb, sxb, syb, snrb) = res[0]
+    npass = 2
 
     if dxb**2 + dyb**2 > 1:
         win2 = swiftir.extractStraightWindow(img1,
                                              (x1croi+dx+dxb, y1croi+dy+dyb),
                                              SIZ)
-        apo2 = swiftir.apodize(win2)
-        (dxc, dyc, sxc, syc, snrc) = swiftir.swim(apo1, apo2)
+        apo2 = swimbatch.apodize(win2[None])
+        res = swimbatch.swimspectra(ff1, swimbatch.spectra(apo2), SHP)
+        (dxc, dyc, sxc, syc, snrc) = res[0]
+        npass = 3
         if snrc>snrb:
             dx += dxb
             dy += dyb
@@ -163,51 +251,59 @@ def transrunmont(r, m, s, ix, iy, r1, s1):
             snr = snrb
             dxb, dyb, sxb, syb, snrb = dxc, dyc, sxc, syc, snrc
 
-    db.exe(f'''insert into {outtbl}
-    (r, m, s, ix, iy,
-    r2, m2, s2, x, y,
-    dx, dy, sx, sy, snr,
-    dxb, dyb, sxb, syb, snrb)
-    values
-    ({r}, {m}, {s}, {ix}, {iy},
-    {r1}, {m1}, {s1}, {x1c}, {y1c},
-    {dx}, {dy}, {sx}, {sy}, {snr}, 
-    {dxb},{dyb},{sxb},{syb},{snrb})''')
+    sink.add(r, m, s, ix, iy,
+             r1, m1, s1, x1c, y1c,
+             dx, dy, sx, sy, snr,
+             dxb, dyb, sxb, syb, snrb, npass)
 
 def transrunmany(r, m):
+    coarse = {}
+    def montageoffsetonce(s, r1, s1):
+        if not PYRAMID:
+            return None
+        if r1 not in coarse:
+            coarse[r1] = montageoffset(r, m, s, r1, s1)
+        return coarse[r1]
     for ix in range(5):
         for iy in range(5):
-            cnt = db.sel(f'''select count(*) from {outtbl}
-            where r={r} and m={m} and r2<{r} and ix={ix} and iy={iy}''')[0][0]
+            cnt = done.count(r, m, ix, iy, r-1)
             if r>1 and cnt==0:
                 s = 0
                 r1 = r-1
                 s1 = ri.nslices(r1)-1
                 if r1==35:
                     s1 -= 1
-                transrunmont(r, m, s, ix, iy, r1, s1)
-            cnt = db.sel(f'''select count(*) from {outtbl}
-            where r={r} and m={m} and r2>{r} and ix={ix} and iy={iy}''')[0][0]
+                transrunmont(r, m, s, ix, iy, r1, s1,
+                             montageoffsetonce(s, r1, s1))
+            cnt = done.count(r, m, ix, iy, r+1)
             if r<ri.nruns() and cnt==0:
                 r1 = r+1
                 s1 = 0
                 s = ri.nslices(r)-1
                 if r==35:
                     s -= 1
-                transrunmont(r, m, s, ix, iy, r1, s1)
+                transrunmont(r, m, s, ix, iy, r1, s1,
+                             montageoffsetonce(s, r1, s1))
             
 maketable()
+done = db.done(outtbl, ['r', 'm', 'ix', 'iy', 'r2'])
                 
 fac = factory.Factory(nthreads)
+sink = db.sink(outtbl,
+               ['r', 'm', 's', 'ix', 'iy',
+                'r2', 'm2', 's2', 'x', 'y',
+                'dx', 'dy', 'sx', 'sy', 'snr',
+                'dxb', 'dyb', 'sxb', 'syb', 'snrb', 'npass'],
+               done=done)
 for r0 in range(0, ri.nruns()):
     r = r0+1
-    cnt = db.sel(f'select count(*) from {outtbl} where r={r}')[0][0]
+    cnt = done.count(r)
     if cnt<ri.nmontages(r)*IX*IY*2:
         for m in range(ri.nmontages(r)):
-            cnt = db.sel(f'''select count(*) from {outtbl}
-            where r={r} and m={m}''')[0][0]
+            cnt = done.count(r, m)
             if cnt < IX*IY*2:
                 fac.request(transrunmany, r, m)
 fac.shutdown()
+sink.close()
 
     
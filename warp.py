@@ -76,6 +76,19 @@ def warpToRectangle(dst, xywh, src, xmodel, ymodel, ximage, yimage):
     cv2.warpPerspective(src, dstbox2src, (w,h), dst=dstbox,
                         flags=cv2.WARP_INVERSE_MAP)
 
+def gridQuad(xx, yy, ximage, yimage, ix, iy):
+    '''GRIDQUAD - Corners of one quad of a grid
+    xmodel, ymodel, ximage, yimage = GRIDQUAD(xx, yy, ximage, yimage, ix, iy)
+    returns the corners of quad (IX, IY) of the grid defined by XX, YY,
+    and the len(yy) x len(xx) arrays XIMAGE, YIMAGE, in the order top-left,
+    bottom-left, top-right, bottom-right, as for WARPTORECTANGLE.'''
+    return (np.array([xx[ix], xx[ix], xx[ix+1], xx[ix+1]]),
+            np.array([yy[iy], yy[iy+1], yy[iy], yy[iy+1]]),
+            np.array([ximage[iy,ix], ximage[iy+1,ix],
+                      ximage[iy,ix+1], ximage[iy+1,ix+1]]),
+            np.array([yimage[iy,ix], yimage[iy+1,ix],
+                      yimage[iy,ix+1], yimage[iy+1,ix+1]]))
+
 def quadToImageBox(xmdlbox, ymdlbox, mdl2img, shp=None):
     '''QUADTOIMAGEBOX - Find rectangle in image needed to cover model quad
     x0,y0,x1,y1 = QUADTOIMAGEBOX(xmodel, ymodel, mdl2img) finds the (integer)
@@ -93,10 +93,10 @@ def combinelevel(a, b, z):
     return topany
 
 def perhapscombinelevel(a, b, z):
-    cnt = db.sel(f'select count(1) from {tbl} where a={a} and b={b} and z={z}')
-    if cnt[0][0]==0:
+    if done.count(a, b, z)==0:
         combinelevel(a, b, z)
         db.exe(f'insert into {tbl} (a, b, z) values ({a}, {b}, {z})')
+        done.add(a, b, z)
             
 def allcombine(a, b):
     Zmax1 = int(np.ceil(Zmax / 2**b)) # max Z at given B
@@ -146,6 +146,7 @@ def infofile():
 
 if __name__ == '__main__':
     maketable()
+    done = db.done(tbl, ['a', 'b', 'z'])
     for a,b in scales:
         allcombine(a, b)
     